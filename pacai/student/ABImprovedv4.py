@@ -1,24 +1,732 @@
+import gc
+import json
+import multiprocessing
+import operator
+import os
+import pickle
 import random
+import time
+from collections import OrderedDict
+from collections import namedtuple
+from multiprocessing import shared_memory
 
 from pacai.agents.capture.capture import CaptureAgent
-from pacai.util import util
+from pacai.core.directions import Directions
+from pacai.student.distanceTable import DistanceField
+from pacai.student.distanceTable import MazeDistanceTable
+from pacai.student.monteCarlo import MonteCarloTreeSearch
+from pacai.student.searchState import SearchRules
+from pacai.student.searchState import SearchState
+from pacai.student.searchState import iterBits
+from pacai.student.searchState import validateSearchState
+
+# Wall-clock seconds we allow ourselves per move on average over the game.
+MOVE_TIME_LIMIT = 0.7
+# Most wall-clock seconds any one move may take, however much time we've banked,
+# kept under the framework's one second move warning.
+MAX_MOVE_TIME = 0.9
+# Hard cap on iterative deepening so trivially small boards don't spin forever.
+MAX_SEARCH_DEPTH = 8
+# Max number of positions remembered by the transposition table.
+TRANSPOSITION_TABLE_SIZE = 200000
+# Search root moves in worker processes when the host has cores to spare.
+PARALLEL_ROOT_SEARCH = True
+# Most worker processes a team's search pool starts, however many cores there are.
+MAX_SEARCH_WORKERS = 4
+# Root moves are searched with alpha a hair under the best score found so far,
+# so a move that ties the best is still scored exactly and stays a candidate.
+TIE_MARGIN = 1e-6
+# Starting size of the shared memory block each move's search state is published in.
+MOVE_BLOCK_SIZE = 1 << 20
+
+# Real turns the team's TurnCache keeps data for: one round of moves, so what an agent
+# worked out on its last move (now its previous observation) is still there.
+TURN_CACHE_TURNS = 4
+# Max number of entries the TurnCache holds over all its turns.
+TURN_CACHE_SIZE = 64
+
+# Opponent models for the enemy nodes of the search (see expandChanceNode).
+MIN_MODEL = 'min'  # enemies always play their best reply (plain alpha-beta)
+EXPECTIMAX_MODEL = 'expectimax'  # enemies play uniformly at random
+MIX_MODEL = 'mix'  # in between, by how adversarially each enemy has played so far
+OPPONENT_MODELS = (MIN_MODEL, EXPECTIMAX_MODEL, MIX_MODEL)
+# How adversarial enemies are assumed to be before we've seen them play, how quickly the
+# estimate follows what they do, and how close to us they have to be for it to count.
+INITIAL_AGGRESSION = 0.5
+AGGRESSION_RATE = 0.1
+OPPONENT_TRACK_RADIUS = 5
+
+# Leaves with a searched enemy this close to our agent are resolved by quiescence search,
+# which follows only tactical moves for at most this many plies and nodes per leaf.
+QUIESCENCE_RADIUS = 2
+QUIESCENCE_MAX_PLIES = 4
+QUIESCENCE_NODE_LIMIT = 32
+
+# Threat-aware depth: lines where a searched enemy is within EXTENSION_RADIUS of us get
+# one more round at the horizon (at most MAX_EXTENSIONS per line), and our quiet moves
+# after the first REDUCTION_MIN_MOVES that end further than REDUCTION_RADIUS from every
+# searched enemy are searched a round shallower first.
+EXTENSION_RADIUS = 3
+MAX_EXTENSIONS = 1
+REDUCTION_MIN_MOVES = 2
+REDUCTION_RADIUS = 6
+
+# With searchAllEnemies, enemies within this maze distance of us are searched as well as
+# the one our role cares about; ones further away play getPolicyMove without branching.
+RELEVANCE_RADIUS = 8
+
+# Search engines an agent can choose its moves with.
+AB_ENGINE = 'ab'  # alpha-beta with iterative deepening
+MCTS_ENGINE = 'mcts'  # Monte Carlo tree search (see monteCarlo.py)
+SEARCH_ENGINES = (AB_ENGINE, MCTS_ENGINE)
+
+# Bound types stored with transposition table values
+EXACT = 0
+LOWER_BOUND = 1  # search failed high, true value >= stored value
+UPPER_BOUND = 2  # search failed low, true value <= stored value
+
+class SearchTimeout(Exception):
+    """
+    Raised inside ABPrune when the per-move time budget runs out mid-iteration.
+    """
+
+    pass
+
+class TranspositionTable(object):
+    """
+    Remembers ABPrune results for positions reached through different move orders.
+    Entries are (depth, value, bound) and are evicted least recently used first
+    once the table is full.
+    """
+
+    def __init__(self, maxSize = TRANSPOSITION_TABLE_SIZE):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.probes = 0
+        self.hits = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def lookup(self, key, depth):
+        """
+        Returns (value, bound) if we have a result searched at least `depth` deep.
+        """
+        self.probes += 1
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < depth:
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1], entry[2]
+
+    def store(self, key, depth, value, bound):
+        entry = self.entries.get(key)
+        # keep the deeper result if we already have one
+        if entry is not None and entry[0] > depth:
+            return
+        self.entries[key] = (depth, value, bound)
+        self.entries.move_to_end(key)
+        self.stores += 1
+        if len(self.entries) > self.maxSize:
+            self.entries.popitem(last = False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def getCounts(self):
+        """
+        The running (probes, hits, stores, evictions) counts, clear doesn't reset them.
+        """
+        return (self.probes, self.hits, self.stores, self.evictions)
+
+    def getStats(self):
+        hitRate = self.hits / self.probes if self.probes > 0 else 0.0
+        return {
+            'probes': self.probes,
+            'hits': self.hits,
+            'hitRate': hitRate,
+            'stores': self.stores,
+            'evictions': self.evictions,
+            'size': len(self.entries),
+        }
+
+class ZobristHasher(object):
+    """
+    Random 64 bit keys for every piece of a capture position (an agent on a cell,
+    food or a capsule on a cell, an agent being a pacman, a scared timer value, the score).
+    A position's key is the XOR of the keys of its pieces, so a move only has to XOR out
+    what it removed and XOR in what it added (see SearchState.apply).
+    Cells are MazeDistanceTable ids.
+    """
+
+    def __init__(self, table, numAgents, seed = 0):
+        # our own generator so hashing never disturbs the game's random state
+        self.rng = random.Random(seed)
+        self.keys = {}
+        cells = range(table.numCells)
+        self.foodKeys = [self.key('food', cell) for cell in cells]
+        self.capsuleKeys = [self.key('capsule', cell) for cell in cells]
+        self.agentKeys = [[self.key('agent', agent, cell) for cell in cells]
+                for agent in range(numAgents)]
+        self.pacmanKeys = [self.key('pacman', agent) for agent in range(numAgents)]
+
+    def key(self, *piece):
+        """
+        Returns the key for a piece, making one the first time the piece is seen
+        (e.g. a scared timer or score value we didn't know about up front).
+        """
+        value = self.keys.get(piece)
+        if value is None:
+            value = self.rng.getrandbits(64)
+            self.keys[piece] = value
+        return value
+
+    def fullKey(self, state):
+        """
+        Builds the key of a SearchState from scratch, O(cells).
+        Only needed for the root of a search.
+        """
+        value = self.key('score', state.score)
+        for agent in range(len(state.positions)):
+            value ^= state.agentKey(agent)
+        for cell in iterBits(state.food):
+            value ^= self.foodKeys[cell]
+        for cell in iterBits(state.capsules):
+            value ^= self.capsuleKeys[cell]
+        return value
+
+class LinearEvaluator(object):
+    """
+    A linear evaluation function, built from a dict of feature name -> weight.
+    Every agent builds its own from its class's evaluatorWeights.
+    The names are compiled into fixed slots of a reused feature list, so scoring a leaf
+    is filling in numbers and one dot product, with no dicts built per call.
+    Features that aren't set count as 0.
+    Names are kept around for debugging and tuning (getFeatureDict, setWeight).
+    """
+
+    def __init__(self, weights):
+        self.featureNames = tuple(weights)
+        self.weights = [weights[name] for name in self.featureNames]
+        # slots.frozen, slots.alive, ... are the indices of those features
+        self.slots = namedtuple('FeatureSlots', self.featureNames)(
+                *range(len(self.featureNames)))
+        self.zeros = [0] * len(self.featureNames)
+        self.features = list(self.zeros)
+        # (low, high) score bounds, see setFeatureRanges
+        self.featureRanges = None
+        self.bounds = None
+
+    def newFeatures(self):
+        """
+        Clears and returns the shared feature list.
+        Evaluations never nest, so one list per evaluator is enough.
+        """
+        self.features[:] = self.zeros
+        return self.features
+
+    def score(self, features):
+        return sum(map(operator.mul, features, self.weights))
+
+    def getFeatureDict(self, features):
+        return dict(zip(self.featureNames, features))
+
+    def getWeightDict(self):
+        return dict(zip(self.featureNames, self.weights))
+
+    def setWeight(self, name, weight):
+        self.weights[getattr(self.slots, name)] = weight
+        if self.featureRanges is not None:
+            self.bounds = self.getBounds(self.featureRanges)
+
+    def setFeatureRanges(self, featureRanges):
+        """
+        Remembers the (low, high) range of every feature, from then on `bounds` is
+        getBounds of them for the current weights.
+        """
+        self.featureRanges = featureRanges
+        self.bounds = self.getBounds(featureRanges)
+
+    def getBounds(self, featureRanges):
+        """
+        The lowest and highest score possible while every feature stays within its
+        (low, high) range in `featureRanges`.
+        """
+        low = 0
+        high = 0
+        for name, weight in zip(self.featureNames, self.weights):
+            featureLow, featureHigh = featureRanges[name]
+            low += min(weight * featureLow, weight * featureHigh)
+            high += max(weight * featureLow, weight * featureHigh)
+        return low, high
+
+class TurnContext(object):
+    """
+    Everything the evaluators need that only depends on the real turn, not on the
+    simulated state being evaluated. Built once per chooseAction and shared by every leaf.
+    """
+
+    def __init__(self, agent, gameState):
+        prevState = agent.getPreviousObservation()
+        self.opponents = agent.getOpponents(gameState)
+        self.startPos = agent.startPos
+        self.enemyStartPos = agent.enemyStartPos
+        self.scared = agent.scared
+        self.enemyScared = agent.enemyScared
+        # enemies that move by getPolicyMove instead of branching the search, and the ones
+        # that branch (only those count as threats, see nearestEnemyDistance)
+        self.policyAgents = agent.policyAgents
+        self.branchingEnemies = [opp for opp in agent.agentAndEnemiesIndices[1:]
+                if opp not in agent.policyAgents]
+
+        # weight of the min part of each enemy's chance nodes (see expandChanceNode)
+        self.minWeights = {}
+        for opp in self.opponents:
+            self.minWeights[opp] = 0.0
+            if agent.opponentModel == MIX_MODEL:
+                self.minWeights[opp] = agent.opponentAggression[opp]
+
+        self.prevPos = None
+        self.prevEnemyPositions = {}
+        if prevState is not None:
+            self.prevPos = prevState.getAgentState(agent.index).getPosition()
+            self.prevEnemyPositions = agent.getEnemyPositions(prevState)
+
+    def enemyRespawned(self, state, opp):
+        """
+        An enemy died if it moved since the real turn and is now on its start position.
+        """
+        if self.prevPos is None:
+            return False
+        enemyPos = state.getAgentPosition(opp)
+        return self.prevEnemyPositions[opp] != enemyPos and enemyPos == self.enemyStartPos
+
+class TurnCache(object):
+    """
+    Data worked out from the real game states our team sees (food and capsule lists,
+    enemy positions, ...), keyed by turn number (the moves left in the game) and name.
+    Both our agents read the same cache, so anything either of them already worked out
+    for a state isn't worked out again, e.g. an agent's previous observation was its
+    current state a round ago. Whenever a new turn starts the turns more than
+    TURN_CACHE_TURNS ago are evicted, and the oldest entries go when it's full.
+    """
+
+    def __init__(self, maxTurns = TURN_CACHE_TURNS, maxSize = TURN_CACHE_SIZE):
+        self.maxTurns = maxTurns
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.currentTurn = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, gameState, name, compute):
+        """
+        The cached `name` of `gameState`, or `compute(gameState)` stored under it.
+        """
+        turn = gameState.getTimeleft()
+        if self.currentTurn is None or turn < self.currentTurn:
+            self.startTurn(turn)
+        key = (turn, name)
+        if key in self.entries:
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        value = compute(gameState)
+        self.entries[key] = value
+        if len(self.entries) > self.maxSize:
+            self.entries.popitem(last = False)
+        return value
+
+    def startTurn(self, turn):
+        """
+        Evicts everything from more than maxTurns turns before `turn`.
+        """
+        self.currentTurn = turn
+        for key in list(self.entries):
+            if key[0] - turn > self.maxTurns:
+                del self.entries[key]
+
+    def getStats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.entries),
+        }
+
+class TeamCoordinator(object):
+    """
+    What the two agents of a team share, handed to both of them by createTeam.
+    Our agents move on different turns with an enemy move in between and score positions
+    with different evaluators, so each still runs its own search. What they share is
+    everything that doesn't depend on whose search it is: the maze data built once per
+    game, the food and capsule distance fields carried from turn to turn (the second agent
+    to move picks up the field the first one just repaired), how each enemy has been
+    playing, which enemy each agent searched against so they can split the work, a
+    TurnCache of what the agents worked out from the real game states, and the pool of
+    worker processes both agents' root moves are searched in.
+    The framework can play several games with the same agents, all of this is per game
+    and starts over when the first of our agents registers for the next one.
+    """
+
+    def __init__(self):
+        self.inGame = False
+        self.gamesPlayed = 0
+        self.gameId = None
+        self.distanceTable = None
+        self.zobrist = None
+        self.searchRules = None
+        self.foodField = None
+        self.capsuleField = None
+        self.defendedFoodField = None
+        self.opponentAggression = {}
+        self.mainEnemies = {}
+        self.turnCache = TurnCache()
+        self.agents = []
+        self.searchPool = None
+        self.sharedAlpha = None
+        self.searchPoolStarted = False
+
+    def registerInitialState(self, agent, gameState):
+        """
+        Starts a new game when the first of our agents registers for it: the one before
+        has ended (see final), or `agent` already registered for it.
+        The game's maze data is built here, and everything kept from the last game dropped.
+        """
+        if self.inGame and agent not in self.agents:
+            return
+        self.stopSearchPool()
+        self.inGame = True
+        self.agents = []
+        # names the game's trace files, our process can play several games a second
+        self.gamesPlayed += 1
+        self.gameId = '%s-%d-%d' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid(),
+                self.gamesPlayed)
+        self.distanceTable = MazeDistanceTable(gameState.getWalls())
+        self.zobrist = ZobristHasher(self.distanceTable, gameState.getNumAgents())
+        self.searchRules = SearchRules(gameState, self.distanceTable, self.zobrist)
+        self.foodField = None
+        self.capsuleField = None
+        self.defendedFoodField = None
+        self.opponentAggression = {}
+        self.mainEnemies = {}
+        self.turnCache = TurnCache()
+
+    def final(self):
+        """
+        The game is over, the next registration starts a new one.
+        """
+        self.inGame = False
+        self.stopSearchPool()
+
+    def registerAgent(self, agent, gameState):
+        """
+        Counts `agent` in for this game, and once all of our agents are in, starts the
+        game's search pool for the ones that search in parallel.
+        """
+        self.agents.append(agent)
+        if len(self.agents) == len(agent.getTeam(gameState)):
+            self.startSearchPool()
+
+    def getSearchPool(self):
+        """
+        The team's search pool, or None to search serially. Started here if the pool
+        wasn't started at registration (e.g. an agent used on its own).
+        """
+        if not self.searchPoolStarted:
+            self.startSearchPool()
+        return self.searchPool
+
+    def startSearchPool(self):
+        """
+        One pool of search workers for the whole team and game, one per spare core up to
+        MAX_SEARCH_WORKERS. Every worker holds a copy of each of our agents that searches in
+        parallel, our agents never search at the same time so they take turns using it.
+        The static maze data (the distance table) goes into shared memory first, so
+        workers read it in place, and each move only publishes the small dynamic part
+        (see publishMove). With a single core, or if the pool can't be started,
+        we stay serial.
+        """
+        self.searchPoolStarted = True
+        agents = [agent for agent in self.agents if agent.parallelSearch]
+        numWorkers = min((os.cpu_count() or 1) - 1, MAX_SEARCH_WORKERS)
+        if numWorkers < 2 or len(agents) == 0:
+            return
+        try:
+            self.distanceTable.share()
+            self.sharedAlpha = multiprocessing.Value('d', float('-inf'))
+            workerAgents = [(type(agent), agent.index, agent.getWorkerConfig(numWorkers))
+                    for agent in agents]
+            self.searchPool = multiprocessing.Pool(numWorkers, initializer = initSearchWorker,
+                    initargs = (workerAgents, self.sharedAlpha))
+        except OSError:
+            self.stopSearchPool()
+            # don't try again on every move, the rest of this game is serial
+            self.searchPoolStarted = True
+
+    def stopSearchPool(self):
+        if self.searchPool is not None:
+            self.searchPool.terminate()
+            self.searchPool.join()
+            self.searchPool = None
+        self.sharedAlpha = None
+        self.searchPoolStarted = False
+        if self.distanceTable is not None:
+            self.distanceTable.unshare()
+
+    def getTeammateEnemy(self, agent, gameState):
+        """
+        The enemy `agent`'s teammate searched against on its last move, if the teammate
+        is a ghost that could eat it, otherwise None.
+        """
+        for teammate in agent.getTeam(gameState):
+            if teammate == agent.index or teammate not in self.mainEnemies:
+                continue
+            teammateState = gameState.getAgentState(teammate)
+            if not teammateState.isPacman() and teammateState.getScaredTimer() == 0:
+                return self.mainEnemies[teammate]
+        return None
+
+class SearchInstrumentation(object):
+    """
+    Optional per-move search counters for an ABPruningCaptureAgent: nodes, cutoffs by depth,
+    leaf evaluations, successor generations (moves made) and the time spent generating vs
+    evaluating.
+    It works by shadowing the agent's evaluate, makeMove and recordCutoff with counting
+    versions on the instance, so an agent without instrumentation runs the plain methods
+    and pays nothing.
+    One JSON line per move is written to the trace file when the game ends.
+    """
+
+    def __init__(self, agent, tracePath):
+        self.agent = agent
+        self.tracePath = tracePath
+        self.moves = []
+        self.startMove()
+
+        # drop the counting versions a previous game's instrumentation left on the agent
+        for name in ('evaluate', 'makeMove', 'recordCutoff'):
+            agent.__dict__.pop(name, None)
+        evaluate = agent.evaluate
+        makeMove = agent.makeMove
+        recordCutoff = agent.recordCutoff
+
+        def timedEvaluate(gameState):
+            startTime = time.perf_counter()
+            value = evaluate(gameState)
+            self.evaluateTime += time.perf_counter() - startTime
+            self.leaves += 1
+            return value
+
+        def timedMakeMove(state, action, index):
+            startTime = time.perf_counter()
+            makeMove(state, action, index)
+            self.successorTime += time.perf_counter() - startTime
+            self.successors += 1
+
+        def countedRecordCutoff(gameState, action, agentIndex, depth):
+            self.cutoffs[depth] = self.cutoffs.get(depth, 0) + 1
+            recordCutoff(gameState, action, agentIndex, depth)
+
+        agent.evaluate = timedEvaluate
+        agent.makeMove = timedMakeMove
+        agent.recordCutoff = countedRecordCutoff
+
+    def startMove(self):
+        self.startTime = time.perf_counter()
+        self.leaves = 0
+        self.successors = 0
+        self.cutoffs = {}
+        self.evaluateTime = 0.0
+        self.successorTime = 0.0
+        # the table's counts run for the whole game, we report what this move added,
+        # plus what the search workers' tables added for it
+        self.startTableCounts = self.agent.transpositionTable.getCounts()
+        self.workerTableCounts = (0, 0, 0, 0)
+
+    def getTableCounts(self):
+        """
+        The agent's (probes, hits, stores, evictions) on this move so far.
+        """
+        counts = self.agent.transpositionTable.getCounts()
+        return tuple(count - start for count, start in zip(counts, self.startTableCounts))
+
+    def getCounters(self):
+        """
+        The counters of the move so far, what a search worker sends back with a root move.
+        """
+        return (self.leaves, self.successors, self.cutoffs, self.evaluateTime,
+                self.successorTime, self.getTableCounts())
+
+    def addCounters(self, counters):
+        """
+        Adds a search worker's getCounters to this move's.
+        """
+        leaves, successors, cutoffs, evaluateTime, successorTime, tableCounts = counters
+        self.leaves += leaves
+        self.successors += successors
+        for depth, count in cutoffs.items():
+            self.cutoffs[depth] = self.cutoffs.get(depth, 0) + count
+        self.evaluateTime += evaluateTime
+        self.successorTime += successorTime
+        self.workerTableCounts = tuple(total + count
+                for total, count in zip(self.workerTableCounts, tableCounts))
+
+    def endMove(self, gameState):
+        probes, hits, stores, evictions = (own + worker
+                for own, worker in zip(self.getTableCounts(), self.workerTableCounts))
+        self.moves.append({
+            'timeleft': gameState.getTimeleft(),
+            'searchedAgents': list(self.agent.agentAndEnemiesIndices),
+            'completedDepth': self.agent.completedDepth,
+            'reRooted': self.agent.reRooted,
+            'nodes': self.agent.nodesSearched,
+            'leaves': self.leaves,
+            'successors': self.successors,
+            'cutoffsByDepth': self.cutoffs,
+            'evaluateTime': self.evaluateTime,
+            'successorTime': self.successorTime,
+            'totalTime': time.perf_counter() - self.startTime,
+            'transpositionTable': {
+                'probes': probes,
+                'hits': hits,
+                'hitRate': hits / probes if probes > 0 else 0.0,
+                'stores': stores,
+                'evictions': evictions,
+                'size': len(self.agent.transpositionTable.entries),
+            },
+            'engine': self.agent.searchEngine,
+            'monteCarlo': self.agent.monteCarlo.getStats(),
+            'turnCache': self.agent.coordinator.turnCache.getStats(),
+        })
+
+    def dump(self):
+        with open(self.tracePath, 'a') as traceFile:
+            for move in self.moves:
+                traceFile.write(json.dumps(move) + '\n')
+        self.moves = []
+
+# Set up in each search worker process by initSearchWorker.
+workerAgents = {}
+workerAlpha = None
+
+def initSearchWorker(agents, sharedAlpha):
+    """
+    Builds this worker's copy of each agent in `agents`, (class, index, config) triples,
+    once per game.
+    `config` holds everything static the search needs (see getWorkerConfig),
+    the distance table in it arrives as the name of its shared memory block.
+    """
+    global workerAlpha
+    for agentClass, index, config in agents:
+        agent = agentClass(index)
+        for name, value in config.items():
+            setattr(agent, name, value)
+        agent.evaluator = LinearEvaluator(agent.evaluatorWeights)
+        agent.evaluator.setFeatureRanges(agent.featureRanges)
+        agent.initSearchState()
+        # our copy of the agent doesn't have a table of its own to fill for every move,
+        # only for the root moves we're given
+        agent.transpositionTable = TranspositionTable(agent.workerTableSize)
+        # counters to send back with every root move when the agent is traced
+        if agent.traced:
+            agent.instrumentation = SearchInstrumentation(agent, None)
+        agent.currentMove = None
+        agent.moveBlock = None
+        workerAgents[index] = agent
+    workerAlpha = sharedAlpha
+
+def loadWorkerMove(agent, moveId, blockName, payloadSize):
+    """
+    Reads the move's dynamic state (root search state, the searched agents and the
+    turn context) from the shared block the main process published it in.
+    Only done for the first root move of each move that this worker picks up.
+    """
+    if agent.moveBlock is None or agent.moveBlock.name != blockName:
+        if agent.moveBlock is not None:
+            agent.moveBlock.close()
+        agent.moveBlock = shared_memory.SharedMemory(name = blockName)
+    with agent.moveBlock.buf[:payloadSize] as payload:
+        rootState, agent.agentAndEnemiesIndices, agent.turn = pickle.loads(payload)
+
+    rootState.rules = agent.searchRules
+    agent.rootState = rootState
+    agent.startTurnSearch(rootState)
+    agent.currentMove = moveId
+
+def searchRootMove(task):
+    """
+    Scores one root move in a worker. The shared alpha is the best root score any worker
+    has found so far in this iteration, so later moves can be cut off early.
+    Returns (root move position, score or None if we ran out of time, nodes searched,
+    the instrumentation's counters or None if the agent isn't traced).
+    """
+    index, moveId, blockName, payloadSize, position, action, depth, deadline = task
+    agent = workerAgents[index]
+    if agent.currentMove != moveId:
+        loadWorkerMove(agent, moveId, blockName, payloadSize)
+    if agent.instrumentation is not None:
+        agent.instrumentation.startMove()
+
+    agent.searchDeadline = deadline
+    agent.nodesSearched = 0
+    agent.extensionsUsed = 0
+    state = agent.rootState
+    a = max(agent.startAlpha, workerAlpha.value - TIE_MARGIN)
+    agent.makeMove(state, action, agent.index)
+    try:
+        value = agent.ABPrune(state, depth, 1, a, agent.startBeta)
+    except SearchTimeout:
+        # the next root move this worker gets starts from the same state
+        state.undoAll()
+        value = None
+    else:
+        agent.unmakeMove(state)
+        with workerAlpha.get_lock():
+            if value > workerAlpha.value:
+                workerAlpha.value = value
+
+    counters = None
+    if agent.instrumentation is not None:
+        counters = agent.instrumentation.getCounters()
+    return position, value, agent.nodesSearched, counters
 
 def createTeam(firstIndex, secondIndex, isRed,
         first = 'pacai.agents.capture.custom.AttackAgent',
-        second = 'pacai.agents.capture.custom.DefenseAgent'):
+        second = 'pacai.agents.capture.custom.DefenseAgent',
+        trace = None,
+        offenseModel = None,
+        defenseModel = None,
+        engine = None,
+        allEnemies = False):
     """
     This function should return a list of two agents that will form the capture team,
     initialized using firstIndex and secondIndex as their agent indexed.
     isRed is True if the red team is being created,
     and will be False if the blue team is being created.
+    Passing `trace` (a path prefix) turns on search instrumentation,
+    each agent writes its trace to `<trace>-<game>-agent<index>.jsonl`, where `<game>` is
+    the time the game started, our process id and the game's number in this process,
+    so every game gets its own files (see TeamCoordinator.registerInitialState).
+    `offenseModel` and `defenseModel` override the agents' opponent models
+    (min, expectimax or mix), and `engine` the search both agents use (ab or mcts).
+    `allEnemies` has both agents search every enemy rather than just the closest one.
+    Both agents get the same TeamCoordinator.
     """
 
     firstAgent = OffensiveABAgent
     secondAgent = DefensiveABAgent
+    # options given on the command line come in as strings
+    allEnemies = allEnemies in (True, 'True', 'true', '1')
+    coordinator = TeamCoordinator()
 
     return [
-        firstAgent(firstIndex),
-        secondAgent(secondIndex),
+        firstAgent(firstIndex, tracePrefix = trace, opponentModel = offenseModel,
+                searchEngine = engine, searchAllEnemies = allEnemies,
+                coordinator = coordinator),
+        secondAgent(secondIndex, tracePrefix = trace, opponentModel = defenseModel,
+                searchEngine = engine, searchAllEnemies = allEnemies,
+                coordinator = coordinator),
     ]
 
 class ABPruningCaptureAgent(CaptureAgent):
@@ -28,8 +736,29 @@ class ABPruningCaptureAgent(CaptureAgent):
     enemy agent moves.
     """
 
-    def __init__(self, index, **kwargs):
+    evaluatorWeights = {
+        'successorScore': 1,
+    }
+    opponentModel = MIN_MODEL
+    searchEngine = AB_ENGINE
+    # Search every enemy instead of just the closest one, see setSearchedAgents.
+    # Off by default, on small layouts the extra branching costs about a ply of depth.
+    searchAllEnemies = False
+
+    def __init__(self, index, tracePrefix = None, opponentModel = None, searchEngine = None,
+            searchAllEnemies = None, coordinator = None, **kwargs):
         super().__init__(index, **kwargs)
+        self.tracePrefix = tracePrefix
+        # an agent created on its own (e.g. in a search worker) has no teammate to share with
+        if coordinator is None:
+            coordinator = TeamCoordinator()
+        self.coordinator = coordinator
+        if opponentModel is not None:
+            self.opponentModel = opponentModel
+        if searchEngine is not None:
+            self.searchEngine = searchEngine
+        if searchAllEnemies is not None:
+            self.searchAllEnemies = searchAllEnemies
         
     def registerInitialState(self, gameState):
         """
@@ -37,6 +766,10 @@ class ABPruningCaptureAgent(CaptureAgent):
         such as the team the agent is on and the `pacai.core.distanceCalculator.Distancer`.
         """
         super().registerInitialState(gameState)
+        # All-pairs maze distances, read by getMazeDistance for the rest of the game,
+        # built by whichever of our agents registers first
+        self.coordinator.registerInitialState(self, gameState)
+        self.distanceTable = self.coordinator.distanceTable
 
         # Initialize a list that can be accessed by the agent later
         # Consisting of itself and its two opponents
@@ -44,16 +777,67 @@ class ABPruningCaptureAgent(CaptureAgent):
         # this is no longer true!
         self.agentAndEnemiesIndices = []
         self.agentAndEnemiesIndices.append(self.index)
+        self.policyAgents = frozenset()
         opponents = self.getOpponents(gameState)
         sampleEnemyPos = None
         for opp in opponents:
             self.agentAndEnemiesIndices.append(opp)
             enemy = gameState.getAgentState(opp)
             sampleEnemyPos = enemy.getPosition()
-        self.depth = 2  # seems like we cannot handle depth 3+
+        self.depth = 2  # fixed depth used when iterative deepening is off
         self.startAlpha = float('-inf')
         self.startBeta = float('inf')
         self.totalTime = gameState.getTimeleft()
+
+        # Iterative deepening: deepen until the per-move time budget runs out
+        self.iterativeDeepening = True
+        self.maxDepth = MAX_SEARCH_DEPTH
+        self.searchDeadline = None
+        self.completedDepth = 0
+        self.timeUsed = 0.0
+
+        # The search runs on compact SearchStates instead of GameStates (see searchState.py).
+        # Their Zobrist keys for the transposition table are updated incrementally as we
+        # search. verifyZobrist checks every incremental key against a full recompute and
+        # verifySearchState checks the simulation against generateSuccessor every turn
+        # (both slow, debug only).
+        self.zobrist = self.coordinator.zobrist
+        self.searchRules = self.coordinator.searchRules
+        self.verifyZobrist = False
+        self.verifySearchState = False
+
+        self.useTranspositionTable = True
+        self.useMoveOrdering = True
+        self.useQuiescence = True
+        self.useSelectiveDepth = True
+        self.initSearchState()
+
+        # Our own evaluator, so tuning our weights (setWeight) leaves other agents alone
+        self.evaluator = LinearEvaluator(self.evaluatorWeights)
+
+        # How enemy nodes are searched. Chance nodes (expectimax and mix) prune with
+        # bounds on our evaluation, worked out from the range of every feature.
+        if self.opponentModel not in OPPONENT_MODELS:
+            raise ValueError('Unknown opponent model: %s' % (self.opponentModel))
+        self.evaluator.setFeatureRanges(self.getFeatureRanges(gameState))
+        self.useProbing = False
+        # kept by the team, so both agents' sightings of an enemy count towards it
+        self.opponentAggression = self.coordinator.opponentAggression
+        for opp in opponents:
+            self.opponentAggression.setdefault(opp, INITIAL_AGGRESSION)
+
+        # MCTS replaces the AB search when it's our engine. Its tree is kept between moves.
+        if self.searchEngine not in SEARCH_ENGINES:
+            raise ValueError('Unknown search engine: %s' % (self.searchEngine))
+        self.monteCarlo = MonteCarloTreeSearch(self)
+
+        # Search counters and timings, only installed when we were given a trace prefix,
+        # written to a file of their own for every game
+        self.instrumentation = None
+        if self.tracePrefix is not None:
+            tracePath = '%s-%s-agent%d.jsonl' % (self.tracePrefix, self.coordinator.gameId,
+                    self.index)
+            self.instrumentation = SearchInstrumentation(self, tracePath)
         self.startPos = gameState.getAgentState(self.index).getPosition()
         self.enemyStartPos = sampleEnemyPos
         
@@ -62,16 +846,259 @@ class ABPruningCaptureAgent(CaptureAgent):
         self.enemyScaredTime = 0
         self.scaredTime = 0
         self.stuckTime = 0
+
+        # Root moves go to the team's pool of worker processes (see TeamCoordinator),
+        # started once the last of our agents has registered
+        self.parallelSearch = PARALLEL_ROOT_SEARCH and self.searchEngine == AB_ENGINE
+        self.searchPool = None
+        self.moveBlock = None
+        self.moveId = 0
+        self.coordinator.registerAgent(self, gameState)
+
+    def initSearchState(self):
+        """
+        The tables and counters the search fills in as it runs.
+        """
+        # Transposition table, cleared every turn since our evals depend on the real turn
+        self.transpositionTable = TranspositionTable()
+
+        # Move ordering so cutoffs fire early: best moves from the previous search (the
+        # principal variation), killer moves per depth, and a history table of moves
+        # that caused cutoffs, which is kept across turns.
+        self.bestMoves = {}
+        self.previousBestMoves = {}
+        self.killerMoves = {}
+        self.historyTable = {}
+        self.nodesSearched = 0
+        self.searchDeadline = None
+        self.instrumentation = None
+        self.unsearchedKey = 0
+        self.reRooted = False
+        self.quiescenceBudget = 0
+        self.extensionsUsed = 0
+
+        # Nearest food and capsule distances, carried from turn to turn
+        self.foodField = None
+        self.capsuleField = None
+        self.defendedFoodField = None
+
+    def getWorkerConfig(self, numWorkers):
+        """
+        The static part of this agent that search workers need, sent to them once per game.
+        Each of the `numWorkers` workers only searches its share of our root moves, so its
+        transposition table gets that share of our table's size.
+        """
+        return {
+            'red': self.red,
+            'distanceTable': self.distanceTable,
+            'zobrist': self.zobrist,
+            'searchRules': self.searchRules,
+            'startPos': self.startPos,
+            'enemyStartPos': self.enemyStartPos,
+            'startAlpha': self.startAlpha,
+            'startBeta': self.startBeta,
+            'useTranspositionTable': self.useTranspositionTable,
+            'useMoveOrdering': self.useMoveOrdering,
+            'useQuiescence': self.useQuiescence,
+            'useSelectiveDepth': self.useSelectiveDepth,
+            'opponentModel': self.opponentModel,
+            'evaluatorWeights': self.evaluator.getWeightDict(),
+            'featureRanges': self.evaluator.featureRanges,
+            'useProbing': self.useProbing,
+            'verifyZobrist': False,
+            'traced': self.instrumentation is not None,
+            'workerTableSize': max(1, TRANSPOSITION_TABLE_SIZE // numWorkers),
+        }
+
+    def stopSearchPool(self):
+        """
+        Stops the team's search pool, we search serially from then on.
+        """
+        self.parallelSearch = False
+        self.searchPool = None
+        self.coordinator.stopSearchPool()
+        if self.moveBlock is not None:
+            self.moveBlock.close()
+            self.moveBlock.unlink()
+            self.moveBlock = None
+
+    def publishMove(self, rootState):
+        """
+        Writes this move's dynamic search state into the shared move block, growing the
+        block if it doesn't fit. Workers read it once per move instead of getting a copy
+        with every root move.
+        Returns the block name and the payload size for the tasks.
+        """
+        payload = pickle.dumps((rootState, self.agentAndEnemiesIndices, self.turn),
+                pickle.HIGHEST_PROTOCOL)
+        if self.moveBlock is None or self.moveBlock.size < len(payload):
+            if self.moveBlock is not None:
+                self.moveBlock.close()
+                self.moveBlock.unlink()
+            size = max(MOVE_BLOCK_SIZE, 2 * len(payload))
+            self.moveBlock = shared_memory.SharedMemory(create = True, size = size)
+        self.moveBlock.buf[:len(payload)] = payload
+        return self.moveBlock.name, len(payload)
     
+    def getMazeDistance(self, pos1, pos2):
+        """
+        Reads maze distances from our precomputed distance table.
+        """
+        return self.distanceTable.getDistance(pos1, pos2)
+
+    def getFeatureRanges(self, gameState):
+        """
+        (low, high) of every feature our evaluator can see this game.
+        Only food scores points, so the score never gets past the food on the board.
+        """
+        totalFood = len(self.getTurnData(gameState, 'food',
+                lambda state: state.getFood().asList()))
+        return {
+            'successorScore': (-totalFood, totalFood),
+        }
+
+    def getTurnData(self, gameState, name, compute):
+        """
+        `compute(gameState)`, worked out once for the whole team (see TurnCache).
+        """
+        return self.coordinator.turnCache.get(gameState, name, compute)
+
+    def getEnemyPositions(self, gameState):
+        """
+        Position of every enemy in `gameState`, by index.
+        """
+        return self.getTurnData(gameState, 'enemyPositions', lambda state: {
+                opp: state.getAgentState(opp).getPosition() for opp in self.getOpponents(state)})
+
+    def updateOpponentAggression(self, gameState):
+        """
+        How adversarially each enemy plays, for the mixed opponent model: whenever an enemy
+        ghost that could eat us was within OPPONENT_TRACK_RADIUS of our pacman, did it take
+        the step that brought it closest to us? Kept as a moving average per enemy.
+        """
+        prevState = self.getPreviousObservation()
+        myState = gameState.getAgentState(self.index)
+        if prevState is None or not myState.isPacman():
+            return
+        table = self.distanceTable
+        myCell = table.getCellId(myState.getPosition())
+        for opp in self.getOpponents(gameState):
+            prevEnemy = prevState.getAgentState(opp)
+            if prevEnemy.isPacman() or prevEnemy.getScaredTimer() > 0:
+                continue
+            prevCell = table.getCellId(prevEnemy.getPosition())
+            if table.getDistanceById(prevCell, myCell) > OPPONENT_TRACK_RADIUS:
+                continue
+            cell = table.getCellId(gameState.getAgentState(opp).getPosition())
+            options = self.searchRules.moves[prevCell].values()
+            if cell not in options:  # it was killed
+                continue
+            closest = min(table.getDistanceById(option, myCell) for option in options)
+            chased = table.getDistanceById(cell, myCell) == closest
+            self.opponentAggression[opp] += AGGRESSION_RATE * (chased
+                    - self.opponentAggression[opp])
+
+    def startTurnSearch(self, rootState):
+        """
+        Gets the search's tables ready for a new real turn, keeping what last turn's
+        search learned that still holds.
+        """
+        # the agents we don't search never move inside the search, so XORing their pieces
+        # out of a state's key gives a key that's still good after they've moved for real
+        self.unsearchedKey = 0
+        for agent in range(rootState.getNumAgents()):
+            if agent not in self.agentAndEnemiesIndices:
+                self.unsearchedKey ^= rootState.agentKey(agent)
+        self.updateDistanceFields(rootState)
+        # stored values were computed with last turn's previous observation and scared
+        # timers, so they can't be trusted now; within this turn they're shared between
+        # all the iterative deepening passes
+        self.transpositionTable.clear()
+        # the best moves are kept, by the key above: if the real moves went the way
+        # we searched, we're now on last turn's principal variation
+        self.startMoveOrdering()
+        self.reRooted = (rootState.key ^ self.unsearchedKey, 0) in self.previousBestMoves
+
+    def updateDistanceFields(self, rootState):
+        """
+        Nearest food and capsule distances for every cell, from the food and capsules on
+        the side we attack.
+        Inside the search we only ever lose food and capsules, which nearestDistance
+        handles by repairing these fields rather than rebuilding them.
+        Between real turns we only lose them as well, so the fields are carried over the
+        same way, along with the repairs the last search already made. Both our agents
+        attack and defend the same food, so the fields are the team's, and each agent
+        carries on from its teammate's move.
+        """
+        team = self.coordinator
+        attackMask = self.searchRules.attackMask[self.index]
+        team.foodField = self.carryField(team.foodField, iterBits(rootState.food & attackMask))
+        team.capsuleField = self.carryField(team.capsuleField,
+                iterBits(rootState.capsules & attackMask))
+        homeMask = self.searchRules.homeMask[self.index]
+        team.defendedFoodField = self.carryField(team.defendedFoodField,
+                iterBits(rootState.food & homeMask))
+        self.foodField = team.foodField
+        self.capsuleField = team.capsuleField
+        self.defendedFoodField = team.defendedFoodField
+
+    def carryField(self, field, sources):
+        """
+        `field` with every source not in `sources` removed, or a new field if we have none
+        or new sources turned up.
+        """
+        sources = frozenset(sources)
+        if field is None or not sources <= field.sources:
+            return DistanceField(self.distanceTable, sources)
+        for source in sorted(field.sources - sources):
+            field = field.without(source)
+        return field
+
+    def nearestDistance(self, field, pos, isPresent):
+        """
+        Maze distance from `pos` to the nearest source of `field` that `isPresent` says
+        still exists in the simulated state (given its cell id), or None if none are left.
+        When the nearest source is gone we drop it from the field and look again.
+        """
+        while True:
+            owner = field.getOwner(pos)
+            if owner is None:
+                return None
+            if isPresent(owner):
+                return field.getDistance(pos)
+            field = field.without(owner)
+
+    def nearestSource(self, field, pos, isPresent):
+        """
+        Cell id of the source nearestDistance measures to, or None.
+        """
+        while True:
+            owner = field.getOwner(pos)
+            if owner is None or isPresent(owner):
+                return owner
+            field = field.without(owner)
+
+    def nearestFoodDistance(self, state, pos):
+        return self.nearestDistance(self.foodField, pos, state.hasFoodAt)
+
+    def final(self, gameState):
+        super().final(gameState)
+        self.stopSearchPool()
+        self.coordinator.final()
+        if self.instrumentation is not None:
+            self.instrumentation.dump()
+
     def updateScared(self, gameState, prevState):
         # If capsule existed in previous state and no longer exists, then
         # depending on which side, update timer
         if prevState is not None:
-            capsules = self.getCapsules(gameState)
-            prevCapsules = self.getCapsules(prevState)
+            capsules = self.getTurnData(gameState, 'capsules', self.getCapsules)
+            prevCapsules = self.getTurnData(prevState, 'capsules', self.getCapsules)
             
-            defendCapsules = self.getCapsulesYouAreDefending(gameState)
-            prevDefendCapsules = self.getCapsulesYouAreDefending(prevState)
+            defendCapsules = self.getTurnData(gameState, 'defendedCapsules',
+                    self.getCapsulesYouAreDefending)
+            prevDefendCapsules = self.getTurnData(prevState, 'defendedCapsules',
+                    self.getCapsulesYouAreDefending)
 
             if len(capsules) != len(prevCapsules):  # a capsule has been eaten
                 self.enemyScaredTime = 40
@@ -98,85 +1125,581 @@ class ABPruningCaptureAgent(CaptureAgent):
         Use AB pruning to find the best action.
         """
         legalMoves = gameState.getLegalActions(self.index)
-        successors = [self.getSuccessor(gameState, action, self.index) for action in legalMoves]
+        bestActions = self.searchRoot(gameState, legalMoves)
+        # return the best move or one of them at random if there's a tie
+        return random.choice(bestActions)
+
+    def searchRoot(self, gameState, legalMoves):
+        """
+        Score every legal move with ABPrune and return the moves tied for the best score.
+        In iterative deepening mode we search depth 1, 2, ... until the move's time budget
+        runs out and keep the answer from the deepest search that finished.
+        """
+        if self.instrumentation is not None:
+            self.instrumentation.startMove()
+        if self.verifySearchState:
+            validateSearchState(self.searchRules, gameState)
+        self.updateOpponentAggression(gameState)
+        self.turn = TurnContext(self, gameState)
+        # the one state the whole search makes and unmakes its moves on
+        rootState = SearchState.fromGameState(self.searchRules, gameState)
+        self.startTurnSearch(rootState)
+        self.nodesSearched = 0
+        self.moveId += 1
+        self.searchPool = None
+        if self.parallelSearch:
+            self.searchPool = self.coordinator.getSearchPool()
+        if self.searchPool is not None:
+            self.movePayload = self.publishMove(rootState)
+
+        # Making and unmaking moves allocates next to nothing that can form a reference
+        # cycle, so the garbage collector is kept off while we search rather than pausing
+        # us at random, and catches up after the move.
+        gcEnabled = gc.isenabled()
+        gc.disable()
+        try:
+            if self.searchEngine == MCTS_ENGINE:
+                bestActions = self.searchRootMonteCarlo(gameState, rootState, legalMoves)
+            elif not self.iterativeDeepening:
+                self.searchDeadline = None
+                bestActions = self.searchRootMoves(rootState, legalMoves, self.depth)
+            else:
+                bestActions = self.searchRootIteratively(gameState, rootState, legalMoves)
+        finally:
+            if gcEnabled:
+                gc.enable()
+
+        if self.instrumentation is not None:
+            self.instrumentation.endMove(gameState)
+        return bestActions
+
+    def searchRootIteratively(self, gameState, rootState, legalMoves):
+        startTime = time.time()
+        budget = self.getMoveTimeBudget(gameState)
+        bestActions = legalMoves
+        self.searchDeadline = None  # depth 1 always runs to completion so we have a move
+        for depth in range(1, self.maxDepth + 1):
+            try:
+                bestActions = self.searchRootMoves(rootState, legalMoves, depth)
+            except SearchTimeout:
+                rootState.undoAll()
+                break
+            self.completedDepth = depth
+            elapsed = time.time() - startTime
+            # the next iteration costs at least as much as this one, don't start it
+            # if it clearly can't finish
+            if elapsed * 2 >= budget:
+                break
+            self.searchDeadline = startTime + budget
+        self.timeUsed += time.time() - startTime
+        return bestActions
+
+    def searchRootMonteCarlo(self, gameState, rootState, legalMoves):
+        """
+        MCTS instead of AB. It's anytime, so it runs for the move's whole time budget,
+        or a fixed number of iterations with iterativeDeepening off so runs are repeatable.
+        """
+        startTime = time.time()
+        deadline = None
+        if self.iterativeDeepening:
+            deadline = startTime + self.getMoveTimeBudget(gameState)
+        bestActions = self.monteCarlo.search(rootState, legalMoves, deadline)
+        self.timeUsed += time.time() - startTime
+        return bestActions
+
+    def getRolloutTarget(self, state):
+        """
+        Cell id our MCTS rollouts step towards, or None to move at random.
+        """
+        return None
+
+    def setSearchedAgents(self, gameState, mainEnemy):
+        """
+        Who the search moves: us and `mainEnemy`, the enemy our role cares most about.
+        With searchAllEnemies every other enemy is in too, branching like `mainEnemy`
+        when it's within RELEVANCE_RADIUS of us, otherwise as a policy agent.
+        """
+        self.agentAndEnemiesIndices = [self.index, mainEnemy]
+        self.policyAgents = frozenset()
+        self.coordinator.mainEnemies[self.index] = mainEnemy
+        if not self.searchAllEnemies:
+            return
+        myPos = gameState.getAgentState(self.index).getPosition()
+        policyAgents = []
+        for opp in self.getOpponents(gameState):
+            if opp == mainEnemy:
+                continue
+            self.agentAndEnemiesIndices.append(opp)
+            oppPos = gameState.getAgentState(opp).getPosition()
+            if self.getMazeDistance(myPos, oppPos) > RELEVANCE_RADIUS:
+                policyAgents.append(opp)
+        self.policyAgents = frozenset(policyAgents)
+
+    def getPolicyMove(self, state, enemy):
+        """
+        The one move a policy agent plays in our search: a ghost that could eat our pacman
+        steps towards it, anything else towards the nearest food we defend.
+        """
+        if (state.isPacman(self.index) and not state.isPacman(enemy)
+                and state.getScaredTimer(enemy) == 0):
+            target = state.positions[self.index]
+        else:
+            target = self.nearestSource(self.defendedFoodField, state.getAgentPosition(enemy),
+                    state.hasFoodAt)
+        if target is None:
+            return Directions.STOP
+        table = self.distanceTable
+        moves = self.searchRules.moves[state.positions[enemy]]
+        return min(state.getLegalActions(enemy),
+                key = lambda action: table.getDistanceById(moves[action], target))
+
+    def startMoveOrdering(self):
+        """
+        Keep last search's best moves around as this search's principal variation,
+        forget the killers (they're only good within one search) and age the history
+        so old cutoffs don't outweigh what we learn this turn.
+        """
+        self.previousBestMoves = self.bestMoves
+        self.bestMoves = {}
+        self.killerMoves = {}
+        for move in list(self.historyTable):
+            self.historyTable[move] //= 2
+            if self.historyTable[move] == 0:
+                del self.historyTable[move]
+
+    def orderMoves(self, state, legalMoves, agentIndex, depth, moveKey):
+        """
+        Principal variation move first, then this depth's killer moves,
+        then everything else by how often it caused a cutoff.
+        """
+        if not self.useMoveOrdering:
+            return legalMoves
+        pvMove = self.bestMoves.get(moveKey)
+        if pvMove is None:
+            pvMove = self.previousBestMoves.get(moveKey)
+        killers = self.killerMoves.get((depth, agentIndex), [])
+        pos = state.positions[agentIndex]
+
+        def moveRank(action):
+            if action == pvMove:
+                return (0, 0)
+            if action in killers:
+                return (1, killers.index(action))
+            return (2, -self.historyTable.get((agentIndex, pos, action), 0))
+
+        return sorted(legalMoves, key = moveRank)
+
+    def recordCutoff(self, state, action, agentIndex, depth):
+        killers = self.killerMoves.setdefault((depth, agentIndex), [])
+        if action not in killers:
+            killers.insert(0, action)
+            del killers[2:]  # two killers per depth is plenty
+        pos = state.positions[agentIndex]
+        historyKey = (agentIndex, pos, action)
+        # deeper cutoffs save more work
+        self.historyTable[historyKey] = self.historyTable.get(historyKey, 0) + (depth + 1) ** 2
+
+    def searchRootMoves(self, rootState, legalMoves, depth):
+        # the previous iteration's best move goes first, or last turn's if we're on
+        # its principal variation
+        rootKey = (rootState.key ^ self.unsearchedKey, 0)
+        legalMoves = self.orderMoves(rootState, legalMoves, self.index, depth, rootKey)
+        # a search cut short by the deadline can leave extensions counted
+        self.extensionsUsed = 0
+        if self.searchPool is not None and len(legalMoves) > 1:
+            bestActions = self.searchRootAtDepthParallel(legalMoves, depth)
+        else:
+            bestActions = self.searchRootAtDepth(rootState, legalMoves, depth)
+        self.bestMoves[rootKey] = bestActions[0]
+        return bestActions
+
+    def searchRootAtDepthParallel(self, legalMoves, depth):
+        """
+        searchRootAtDepth with each root move's subtree searched by a worker process.
+        Tasks only carry the root move, the rest was published once for the move.
+        Raises SearchTimeout if any worker ran out of time, like the serial search would.
+        """
+        self.coordinator.sharedAlpha.value = self.startAlpha
+        blockName, payloadSize = self.movePayload
+        tasks = [(self.index, self.moveId, blockName, payloadSize, position, action, depth,
+                self.searchDeadline) for position, action in enumerate(legalMoves)]
+
+        scores = [None] * len(legalMoves)
+        timedOut = False
+        results = self.searchPool.imap_unordered(searchRootMove, tasks)
+        for position, score, nodes, counters in results:
+            self.nodesSearched += nodes
+            if counters is not None and self.instrumentation is not None:
+                self.instrumentation.addCounters(counters)
+            if score is None:
+                timedOut = True
+            scores[position] = score
+        if timedOut:
+            raise SearchTimeout()
+
+        bestScore = max(scores)
+        return [a for a, s in zip(legalMoves, scores) if s == bestScore]
+
+    def searchRootAtDepth(self, rootState, legalMoves, depth):
         scores = []
+        bestScore = self.startAlpha
         # for each successor, get the AB Pruning score
-        # Simulate our agent acting by first looking at a successor
+        # Simulate our agent acting by first making its move on the root state
         # start ABPruning at 1 to simulate enemy agents acting after our agent "acts"
-        for successor in successors:
-            scores.append(self.ABPrune(successor, self.depth, 1, self.startAlpha, self.startBeta))
+        for action in legalMoves:
+            # like the workers' shared alpha, moves that can't reach the best score so far
+            # are cut off, and ones that tie it are still scored exactly
+            a = max(self.startAlpha, bestScore - TIE_MARGIN)
+            self.makeMove(rootState, action, self.index)
+            scores.append(self.ABPrune(rootState, depth, 1, a, self.startBeta))
+            self.unmakeMove(rootState)
+            bestScore = max(bestScore, scores[-1])
         # find the best score
         bestScore = max(scores)
         # explanation: a at start means don't change the value of the retrieved item;
         # and only retrieve items that have max value
-        bestActions = [a for a, s in zip(legalMoves, scores) if s == bestScore]
-        # return the best move or one of them at random if there's a tie
-        return random.choice(bestActions)
+        return [a for a, s in zip(legalMoves, scores) if s == bestScore]
+
+    def getMoveTimeBudget(self, gameState):
+        """
+        Seconds we may spend on this move.
+        getTimeleft() counts the moves remaining in the game (shared by all agents),
+        so we give ourselves MOVE_TIME_LIMIT per move we make over the whole game
+        and spread whatever is left of that bank over the moves we have left, up to
+        MAX_MOVE_TIME. Moves that finish early (iterative deepening stops when the next
+        depth clearly won't fit) bank time that later moves can spend.
+        """
+        numAgents = gameState.getNumAgents()
+        totalMoves = max(1, self.totalTime // numAgents)
+        movesLeft = max(1, gameState.getTimeleft() // numAgents)
+        bank = totalMoves * MOVE_TIME_LIMIT - self.timeUsed
+        return max(0.0, min(MAX_MOVE_TIME, bank / movesLeft))
+
+    def ABPrune(self, state, depth, indexInAgentsList, a, b):
+        if self.searchDeadline is not None and time.time() > self.searchDeadline:
+            raise SearchTimeout()
+        self.nodesSearched += 1
+        if not self.useTranspositionTable:
+            return self.expandNode(state, depth, indexInAgentsList, a, b)
+
+        tableKey = (state.key, indexInAgentsList)
+        entry = self.transpositionTable.lookup(tableKey, depth)
+        if entry is not None:
+            value, bound = entry
+            if bound == EXACT:
+                return value
+            if bound == LOWER_BOUND and value >= b:
+                return value
+            if bound == UPPER_BOUND and value <= a:
+                return value
+
+        value = self.expandNode(state, depth, indexInAgentsList, a, b)
+        # a value outside the (a, b) window is only a bound on the true value
+        if depth == 0 and not self.useQuiescence:
+            bound = EXACT
+        elif value <= a:
+            bound = UPPER_BOUND
+        elif value >= b:
+            bound = LOWER_BOUND
+        else:
+            bound = EXACT
+        self.transpositionTable.store(tableKey, depth, value, bound)
+        return value
 
-    def ABPrune(self, gameState, depth, indexInAgentsList, a, b):
+    def expandNode(self, state, depth, indexInAgentsList, a, b):
+        # if max depth reached, evaluate without generating any successors
+        if depth == 0:
+            if self.useQuiescence and self.isNoisy(state):
+                self.quiescenceBudget = QUIESCENCE_NODE_LIMIT
+                return self.quiesce(state, indexInAgentsList, a, b, QUIESCENCE_MAX_PLIES)
+            return self.evaluate(state)  # return state utility using eval function
         # get the index of the agent we're currently simulating
         agentIndex = self.agentAndEnemiesIndices[indexInAgentsList]
-        legalMoves = gameState.getLegalActions(agentIndex)
-        successors = [self.getSuccessor(gameState, action, agentIndex) for action in legalMoves]
-        # if state is terminal (no successors) or max depth reached
-        if depth == 0 or len(successors) <= 0:
-            return self.evaluate(gameState)  # return state utility using eval function
+        legalMoves = state.getLegalActions(agentIndex)
+        # if state is terminal (no successors)
+        if len(legalMoves) <= 0:
+            return self.evaluate(state)
+        if agentIndex in self.turn.policyAgents:
+            # too far away to matter much, it plays its policy move without branching
+            nextAgentIndex = (indexInAgentsList + 1) % len(self.agentAndEnemiesIndices)
+            nextDepth = depth - 1 if nextAgentIndex == 0 else depth
+            self.makeMove(state, self.getPolicyMove(state, agentIndex), agentIndex)
+            value = self.ABPrune(state, nextDepth, nextAgentIndex, a, b)
+            self.unmakeMove(state)
+            return value
+        moveKey = (state.key ^ self.unsearchedKey, indexInAgentsList)
+        legalMoves = self.orderMoves(state, legalMoves, agentIndex, depth, moveKey)
+        # each move is made on the state, searched and unmade again, no state is copied
+        bestAction = None
         if indexInAgentsList == 0:  # if agent is friendly (Maximizer)
             value = float('-inf')
-            for successor in successors:
-                value = max(value, self.ABPrune(successor, depth, indexInAgentsList + 1, a, b))
+            # with an enemy close by, the last round gets another round after it
+            extend = (self.useSelectiveDepth and depth == 1
+                    and self.extensionsUsed < MAX_EXTENSIONS
+                    and self.nearestEnemyDistance(state) <= EXTENSION_RADIUS)
+            if extend:
+                self.extensionsUsed += 1
+            for i, action in enumerate(legalMoves):
+                self.makeMove(state, action, agentIndex)
+                if extend:
+                    childValue = self.ABPrune(state, depth + 1, indexInAgentsList + 1, a, b)
+                elif self.isReducible(state, i, depth):
+                    # late quiet move far from the enemies, searched a round shallower,
+                    # and again at full depth only if it looks better than what we have
+                    childValue = self.ABPrune(state, depth - 1, indexInAgentsList + 1, a, b)
+                    if childValue > a:
+                        childValue = self.ABPrune(state, depth, indexInAgentsList + 1, a, b)
+                else:
+                    childValue = self.ABPrune(state, depth, indexInAgentsList + 1, a, b)
+                self.unmakeMove(state)
+                if childValue > value:
+                    value = childValue
+                    bestAction = action
                 if value >= b:
-                    return value
+                    self.recordCutoff(state, action, agentIndex, depth)
+                    break
                 a = max(a, value)
-            return value
-        else:  # if agent is enemy (Minimizer)
+            if extend:
+                self.extensionsUsed -= 1
+        else:  # if agent is enemy (Minimizer, or a chance node)
             value = float('inf')
             nextAgentIndex = indexInAgentsList + 1
             nextDepth = depth
             if nextAgentIndex >= len(self.agentAndEnemiesIndices):
                 nextAgentIndex = 0  # loop back to pacman
                 nextDepth = depth - 1
-            for successor in successors:
-                value = min(value, self.ABPrune(successor, nextDepth, nextAgentIndex, a, b))
-                if value <= a:
-                    return value
-                b = min(b, value)
-            return value
+            if self.opponentModel != MIN_MODEL:
+                value, bestAction = self.expandChanceNode(state, depth, legalMoves, agentIndex,
+                        nextDepth, nextAgentIndex, a, b)
+            else:
+                for action in legalMoves:
+                    self.makeMove(state, action, agentIndex)
+                    childValue = self.ABPrune(state, nextDepth, nextAgentIndex, a, b)
+                    self.unmakeMove(state)
+                    if childValue < value:
+                        value = childValue
+                        bestAction = action
+                    if value <= a:
+                        self.recordCutoff(state, action, agentIndex, depth)
+                        break
+                    b = min(b, value)
+        self.bestMoves[moveKey] = bestAction
+        return value
+
+    def expandChanceNode(self, state, depth, legalMoves, agentIndex, nextDepth, nextIndex, a, b):
+        """
+        An enemy node under the expectimax or mixed opponent model, worth
+        w * (min over the enemy's moves) + (1 - w) * (mean over its moves), where w is 0 for
+        expectimax and our estimate of how adversarially this enemy plays for mix.
+        Pruned star1 style: our evaluation is bounded (evaluator.bounds), so once some moves are
+        searched the node's value is bounded too, and each move is only searched with the
+        window that can still take the node's value across (a, b).
+        With useProbing (star2), when the moves hand the turn back to our max nodes each is
+        first searched with our first move only, a lower bound on it that can fail the node
+        high early. Those probes cost more than they saved on our layouts, so it's off.
+        Returns (value, the enemy's lowest scoring move).
+        """
+        low, high = self.evaluator.bounds
+        w = self.turn.minWeights[agentIndex]
+        share = (1 - w) / len(legalMoves)  # weight of each move in the mean part
+
+        lowerBounds = [low] * len(legalMoves)
+        if self.useProbing and nextIndex == 0 and nextDepth > 0:
+            for i, action in enumerate(legalMoves):
+                self.makeMove(state, action, agentIndex)
+                lowerBounds[i] = self.probe(state, nextDepth)
+                self.unmakeMove(state)
+            value = w * min(lowerBounds) + share * sum(lowerBounds)
+            if value >= b:
+                return value, None
+
+        total = 0  # sum of the values of the moves searched so far
+        minValue = float('inf')
+        bestAction = None
+        restLower = sum(lowerBounds)
+        for i, action in enumerate(legalMoves):
+            restLower -= lowerBounds[i]
+            restHigh = (len(legalMoves) - i - 1) * high
+            floor = min([minValue] + lowerBounds[i + 1:])
+            # this move's value at or under childAlpha keeps the node at or under a,
+            # at or over childBeta keeps it at or over b
+            childAlpha = (a - share * (total + restHigh)) / (w + share)
+            childBeta = (b - share * (total + restLower)) / (w + share)
+            if childBeta > floor:  # then the min part is stuck at floor
+                childBeta = float('inf')
+                if share > 0:
+                    childBeta = (b - w * floor) / share - total - restLower
+            if childAlpha >= high:
+                return w * min(minValue, high) + share * (total + high + restHigh), bestAction
+            if childBeta <= low:
+                return w * min(floor, low) + share * (total + low + restLower), bestAction
+
+            self.makeMove(state, action, agentIndex)
+            value = self.ABPrune(state, nextDepth, nextIndex, childAlpha, childBeta)
+            self.unmakeMove(state)
+            if value <= childAlpha:
+                self.recordCutoff(state, action, agentIndex, depth)
+                return w * min(minValue, value) + share * (total + value + restHigh), action
+            if value >= childBeta:
+                self.recordCutoff(state, action, agentIndex, depth)
+                return w * min(floor, value) + share * (total + value + restLower), action
+            total += value
+            if value < minValue:
+                minValue = value
+                bestAction = action
+        return w * minValue + share * total, bestAction
+
+    def probe(self, state, depth):
+        """
+        A lower bound on the value of our max node at `state`: the value of our first
+        ordered move alone. It's searched exactly, so the full search of that move later on
+        is a transposition table hit.
+        """
+        low, high = self.evaluator.bounds
+        legalMoves = state.getLegalActions(self.index)
+        moveKey = (state.key ^ self.unsearchedKey, 0)
+        action = self.orderMoves(state, legalMoves, self.index, depth, moveKey)[0]
+        self.makeMove(state, action, self.index)
+        value = self.ABPrune(state, depth, 1, low, high)
+        self.unmakeMove(state)
+        return value
+
+    def nearestEnemyDistance(self, state):
+        """
+        Maze distance from our agent to the closest searched enemy (policy agents aside).
+        """
+        myCell = state.positions[self.index]
+        return min(self.distanceTable.getDistanceById(myCell, state.positions[enemy])
+                for enemy in self.turn.branchingEnemies)
+
+    def isNoisy(self, state):
+        """
+        A searched enemy is close enough to our agent that someone could get eaten
+        in the next few moves, so the evaluation can't be trusted yet.
+        """
+        return self.nearestEnemyDistance(state) <= QUIESCENCE_RADIUS
+
+    def isReducible(self, state, moveNumber, depth):
+        """
+        Whether the move just made (the `moveNumber`th in order) can be searched
+        a round shallower: a late, quiet move that leaves us far from every enemy.
+        """
+        return (self.useSelectiveDepth and depth >= 2 and moveNumber >= REDUCTION_MIN_MOVES
+                and not state.isTacticalMove()
+                and self.nearestEnemyDistance(state) > REDUCTION_RADIUS)
 
-    def getSuccessor(self, gameState, action, index):
+    def isThreatened(self, state):
         """
-        Finds the next successor which is a grid position (location tuple).
+        Our pacman has an enemy ghost next to it that could eat it.
         """
+        if not state.isPacman(self.index):
+            return False
+        myCell = state.positions[self.index]
+        for enemy in self.turn.branchingEnemies:
+            if (not state.isPacman(enemy) and state.getScaredTimer(enemy) == 0
+                    and self.distanceTable.getDistanceById(myCell, state.positions[enemy]) <= 1):
+                return True
+        return False
 
-        successor = gameState.generateSuccessor(index, action)
-        pos = successor.getAgentState(index).getPosition()
+    def quiesce(self, state, indexInAgentsList, a, b, pliesLeft):
+        """
+        Searches past a noisy leaf along tactical moves only (captures, capsule grabs,
+        a pacman making it home) until the position is quiet, so a leaf one step from
+        getting eaten isn't scored as if nothing was about to happen.
+        Whoever is to move may also stand pat on the evaluation, except our pacman with
+        a ghost next to it, which has to find a way out with any of its moves.
+        Enemies minimize here whatever the opponent model, captures are what they play.
+        Cut off after QUIESCENCE_MAX_PLIES plies or QUIESCENCE_NODE_LIMIT nodes.
+        """
+        if pliesLeft == 0 or self.quiescenceBudget <= 0 or not self.isNoisy(state):
+            return self.evaluate(state)
+        self.quiescenceBudget -= 1
+        self.nodesSearched += 1
+        agentIndex = self.agentAndEnemiesIndices[indexInAgentsList]
+        nextIndex = (indexInAgentsList + 1) % len(self.agentAndEnemiesIndices)
+        if agentIndex in self.turn.policyAgents:
+            self.makeMove(state, self.getPolicyMove(state, agentIndex), agentIndex)
+            value = self.quiesce(state, nextIndex, a, b, pliesLeft - 1)
+            self.unmakeMove(state)
+            return value
+        maximizing = indexInAgentsList == 0
+        allMoves = maximizing and self.isThreatened(state)
 
-        if (pos != util.nearestPoint(pos)):
-            # Only half a grid position was covered.
-            return successor.generateSuccessor(index, action)
+        if allMoves:
+            value = float('-inf')
         else:
-            return successor
+            value = self.evaluate(state)
+            if (maximizing and value >= b) or (not maximizing and value <= a):
+                return value
+        for action in state.getLegalActions(agentIndex):
+            self.makeMove(state, action, agentIndex)
+            childValue = None
+            if allMoves or state.isTacticalMove():
+                childValue = self.quiesce(state, nextIndex, a, b, pliesLeft - 1)
+            self.unmakeMove(state)
+            if childValue is None:
+                continue
+            if maximizing:
+                value = max(value, childValue)
+                if value >= b:
+                    break
+                a = max(a, value)
+            else:
+                value = min(value, childValue)
+                if value <= a:
+                    break
+                b = min(b, value)
+        return value
 
-    def evaluate(self, gameState):
+    def makeMove(self, state, action, index):
+        """
+        Plays `action` for agent `index` on the search state, see unmakeMove.
+        Agents move a whole cell per turn, so unlike GameStates there are no half steps.
+        """
+        state.apply(index, action)
+        if self.verifyZobrist:
+            fullKey = self.zobrist.fullKey(state)
+            if state.key != fullKey:
+                raise ValueError('Incremental Zobrist key %d does not match full key %d'
+                        ' after agent %d played %s' % (state.key, fullKey, index, action))
+
+    def unmakeMove(self, state):
+        """
+        Takes back the last move made on the search state.
+        """
+        state.undo()
+
+    def evaluate(self, state):
         """
         Look ahead agents evaluate future states, not actions from the
         current state.
         Computes a linear combination of features and feature weights.
         """
-        features = {
-            'successorScore': self.getScore(gameState)
-        }
-        weights = {
-            'successorScore': 1,
-        }
-        stateEval = sum(features[feature] * weights[feature] for feature in features)
-        return stateEval
+        features = self.evaluator.newFeatures()
+        features[self.evaluator.slots.successorScore] = self.getScore(state)
+        return self.evaluator.score(features)
 
 
 class OffensiveABAgent(ABPruningCaptureAgent):
     """
     An offensive version of the AB pruning agent.
     """
+
+    evaluatorWeights = {
+        'successorScore': 100,
+        'distanceToFood': 10,
+        'numberOfGhosts': -1000,
+        'distanceToCapsule': 50,
+        'numCapsules': -100,
+        'frozen': -1,
+        'attacking': 10,
+        'numInvaders': -1000,
+        'distanceToInvader': 1,
+        'alive': 1,
+        'numAliveOpponents': -1000,
+        'numScaredGhosts': -100,
+    }
+
     def registerInitialState(self, gameState):
         """
         This method handles the initial setup of the agent and populates useful fields,
@@ -185,6 +1708,24 @@ class OffensiveABAgent(ABPruningCaptureAgent):
         super().registerInitialState(gameState)
         self.depth = 2
 
+    def getFeatureRanges(self, gameState):
+        ranges = super().getFeatureRanges(gameState)
+        numOpponents = len(self.getOpponents(gameState))
+        ranges.update({
+            'distanceToFood': (0, 2),
+            'numberOfGhosts': (0, numOpponents),
+            'distanceToCapsule': (0, 2),
+            'numCapsules': (0, len(self.getTurnData(gameState, 'capsules', self.getCapsules))),
+            'frozen': (0, 1),
+            'attacking': (0, 1),
+            'numInvaders': (0, numOpponents),
+            'distanceToInvader': (0, 1),
+            'alive': (0, 1),
+            'numAliveOpponents': (0, numOpponents),
+            'numScaredGhosts': (0, numOpponents),
+        })
+        return ranges
+
     def chooseAction(self, gameState):
         """
         Use AB pruning to find the best action.
@@ -206,137 +1747,116 @@ class OffensiveABAgent(ABPruningCaptureAgent):
         # i.e. the closest enemy
         # enemies = [gameState.getAgentState(i) for i in self.getOpponents(gameState)]
         opponents = self.getOpponents(gameState)
+        enemyPositions = self.getEnemyPositions(gameState)
         closestEnemyIndex = opponents[0]
         minDist = float('inf')
         for oppIndex in opponents:
-            enemy = gameState.getAgentState(oppIndex)
-            dist = self.getMazeDistance(myPos, enemy.getPosition())
+            dist = self.getMazeDistance(myPos, enemyPositions[oppIndex])
             if dist < minDist:
                 minDist = dist
                 closestEnemyIndex = oppIndex
-        self.agentAndEnemiesIndices = [self.index, closestEnemyIndex]
+        self.setSearchedAgents(gameState, closestEnemyIndex)
         # End of updating closest enemy index
 
         self.updateScared(gameState, prevState)
 
-        successors = [self.getSuccessor(gameState, action, self.index) for action in legalMoves]
-        scores = []
-        # Simulate our agent acting by first looking at a successor
-        # start ABPruning at 1 to simulate enemy agents acting after our agent "acts"
-        for successor in successors:
-            scores.append(self.ABPrune(successor, self.depth, 1, self.startAlpha, self.startBeta))
-        bestScore = max(scores)
-        # explanation: a at start means don't change the value of the retrieved item;
-        # and only retrieve items that have max value
-        bestActions = [a for a, s in zip(legalMoves, scores) if s == bestScore]
+        bestActions = self.searchRoot(gameState, legalMoves)
         return random.choice(bestActions)
 
-    def evaluate(self, gameState):
+    def getRolloutTarget(self, state):
+        """
+        Rollouts head for the nearest food left.
+        """
+        return self.nearestSource(self.foodField, state.getAgentPosition(self.index),
+                state.hasFoodAt)
+
+    def evaluate(self, state):
         """
         Look ahead agents evaluate future states, not actions from the
         current state.
         Computes a linear combination of features and feature weights.
         """
-        return self.offensiveEval(gameState)
+        return self.offensiveEval(state)
 
-    def offensiveEval(self, gameState):
-        features = {
-            'successorScore': self.getScore(gameState)
-        }
-        weights = {
-            'successorScore': 100,
-            'distanceToFood': 10,
-            'numberOfGhosts': -1000,
-            'distanceToCapsule': 50,
-            'numCapsules': -100,
-            'frozen': -1,
-            'attacking': 10,
-            'numInvaders': -1000,
-            'distanceToInvader': 1,
-            'alive': 1,
-            'numAliveOpponents': -1000,
-            'numScaredGhosts': -100,
-        }
-        myState = gameState.getAgentState(self.index)
-        myPos = gameState.getAgentState(self.index).getPosition()
-        prevState = self.getPreviousObservation()
-        prevPos = None
-        if prevState is not None:
-            prevPos = prevState.getAgentState(self.index).getPosition()
+    def offensiveEval(self, state):
+        slots = self.evaluator.slots
+        features = self.evaluator.newFeatures()
+        features[slots.successorScore] = self.getScore(state)
+        turn = self.turn
+        myPos = state.getAgentPosition(self.index)
+        isPacman = state.isPacman(self.index)
+        prevPos = turn.prevPos
+        if prevPos is not None:
             if (myPos == prevPos):
-                features['frozen'] = 1  # disincentivize freezing up
+                features[slots.frozen] = 1  # disincentivize freezing up
 
-        features['attacking'] = 0
-        if (myState.isPacman()):
-            features['attacking'] = 1
+        features[slots.attacking] = 0
+        if (isPacman):
+            features[slots.attacking] = 1
 
         # a state leads to us dying if our position changes from our previous state
         # and the new state is in the starting position
         if prevPos is not None:
-            killed = prevPos != myPos and myPos == self.startPos
-            features['alive'] = 1
+            killed = prevPos != myPos and myPos == turn.startPos
+            features[slots.alive] = 1
             if killed:
-                features['alive'] = 0
+                features[slots.alive] = 0
 
-        # allies = [gameState.getAgentState(i) for i in self.getTeam(gameState) if i != self.index]
-        enemies = [gameState.getAgentState(i) for i in self.getOpponents(gameState)]
-
-        features['numAliveOpponents'] = len(enemies)
-        for opp in self.getOpponents(gameState):
-            prevEnemyPos = None
-            if prevState is not None:
-                prevEnemyPos = prevState.getAgentState(opp).getPosition()
-                currentEnemyPos = gameState.getAgentState(opp).getPosition()
-                if prevEnemyPos != currentEnemyPos and currentEnemyPos == self.enemyStartPos:
-                    features['numAliveOpponents'] -= 1
+        features[slots.numAliveOpponents] = len(turn.opponents)
+        for opp in turn.opponents:
+            if turn.enemyRespawned(state, opp):
+                features[slots.numAliveOpponents] -= 1
         # tell agent to KILL enemies
 
-        ghosts = [a for a in enemies if not a.isPacman() and a.getPosition() is not None]
+        ghosts = [opp for opp in turn.opponents if not state.isPacman(opp)]
         # Compute distance to the nearest food.
-        foodList = self.getFood(gameState).asList()
-        if (len(foodList) > 0):
-            minDistance = min([self.getMazeDistance(myPos, food) for food in foodList])
-            features['distanceToFood'] = 1 / minDistance**2 + 1
+        minDistance = self.nearestFoodDistance(state, myPos)
+        if minDistance is not None:
+            features[slots.distanceToFood] = 1 / minDistance**2 + 1
         
-        capsuleList = self.getCapsules(gameState)
-        if (len(capsuleList) > 0):
-            minDistance = min([self.getMazeDistance(myPos, capsule) for capsule in capsuleList])
-            features['distanceToCapsule'] = 1 / minDistance + 1  # try to go for capsules more
-        features['numCapsules'] = len(capsuleList)  # incentivize eating capsules
+        numCapsules = state.countCapsules(self.searchRules.attackMask[self.index])
+        if (numCapsules > 0):
+            minDistance = self.nearestDistance(self.capsuleField, myPos, state.hasCapsuleAt)
+            features[slots.distanceToCapsule] = 1 / minDistance + 1  # try to go for capsules more
+        features[slots.numCapsules] = numCapsules  # incentivize eating capsules
 
-        features['numberOfGhosts'] = len(ghosts)  # incentivizes us to reduce num ghosts
+        features[slots.numberOfGhosts] = len(ghosts)  # incentivizes us to reduce num ghosts
 
-        invaders = [a for a in enemies if a.isPacman() and a.getPosition() is not None]
-        features['numInvaders'] = len(invaders)
+        invaders = [opp for opp in turn.opponents if state.isPacman(opp)]
+        features[slots.numInvaders] = len(invaders)
         # if there's an invader and we're a ghost
-        features['distanceToInvader'] = 0
+        features[slots.distanceToInvader] = 0
         # do not chase invaders if we are scared!
-        if (len(invaders) > 0 and not myState.isPacman() and not self.scared):
-            dists = [self.getMazeDistance(myPos, a.getPosition()) for a in invaders]
-            features['distanceToInvader'] = 1 / (min(dists) + 1)
+        if (len(invaders) > 0 and not isPacman and not turn.scared):
+            dists = [self.getMazeDistance(myPos, state.getAgentPosition(opp)) for opp in invaders]
+            features[slots.distanceToInvader] = 1 / (min(dists) + 1)
             # incentivize agent to reduce the number of invaders by eating them
         
         # Kill scared ghosts if we can, but DO NOT CHASE THEM
-        features['numScaredGhosts'] = 0
-        if (len(ghosts) > 0 and self.enemyScared):
-            features['numScaredGhosts'] = len(ghosts)
-            for opp in self.getOpponents(gameState):
-                if not gameState.getAgentState(opp).isPacman():
-                    prevEnemyPos = None
-                    if prevState is not None:
-                        prevEnemyPos = prevState.getAgentState(opp).getPosition()
-                        curEnemyPos = gameState.getAgentState(opp).getPosition()
-                        if prevEnemyPos != curEnemyPos and curEnemyPos == self.enemyStartPos:
-                            features['numScaredGhosts'] -= 1
-
-        stateEval = sum(features[feature] * weights[feature] for feature in features)
-        return stateEval
+        features[slots.numScaredGhosts] = 0
+        if (len(ghosts) > 0 and turn.enemyScared):
+            features[slots.numScaredGhosts] = len(ghosts)
+            for opp in ghosts:
+                if turn.enemyRespawned(state, opp):
+                    features[slots.numScaredGhosts] -= 1
+
+        return self.evaluator.score(features)
         
 
 class DefensiveABAgent(ABPruningCaptureAgent):
     """
     An defensive version of the AB pruning agent.
     """
+
+    evaluatorWeights = {
+        'distanceToEnemies': 1,
+        'distanceToInvader': 100,
+        'onDefense': 1,
+        'numInvaders': -1000,
+        'frozen': 0,
+        'alive': 10,
+        'distanceBetweenEnemyAndFood': 100,
+    }
     
     def registerInitialState(self, gameState):
         """
@@ -345,7 +1865,21 @@ class DefensiveABAgent(ABPruningCaptureAgent):
         """
         super().registerInitialState(gameState)
         self.depth = 2
-        
+
+    def getFeatureRanges(self, gameState):
+        ranges = super().getFeatureRanges(gameState)
+        numOpponents = len(self.getOpponents(gameState))
+        ranges.update({
+            'distanceToEnemies': (0, 1),
+            'distanceToInvader': (0, 1),
+            'onDefense': (0, 1),
+            'numInvaders': (0, numOpponents),
+            'frozen': (0, 1),
+            'alive': (0, 1),
+            'distanceBetweenEnemyAndFood': (0, numOpponents * self.distanceTable.getDiameter()),
+        })
+        return ranges
+
     def chooseAction(self, gameState):
         """
         Use AB pruning to find the best action.
@@ -358,100 +1892,91 @@ class DefensiveABAgent(ABPruningCaptureAgent):
         opponents = self.getOpponents(gameState)
         closestEnemyIndex = opponents[0]
         minDist = float('inf')
+        # leave the invader our teammate is hunting at home to it when there's another one
+        invaders = [opp for opp in opponents if gameState.getAgentState(opp).isPacman()]
+        teammateEnemy = self.coordinator.getTeammateEnemy(self, gameState)
+        if teammateEnemy in invaders and len(invaders) > 1:
+            invaders.remove(teammateEnemy)
+        enemyPositions = self.getEnemyPositions(gameState)
         for oppIndex in opponents:
-            enemy = gameState.getAgentState(oppIndex)
-            if enemy.isPacman() and enemy.getPosition is not None:
-                dist = self.getMazeDistance(myPos, enemy.getPosition())
+            if oppIndex in invaders and enemyPositions[oppIndex] is not None:
+                dist = self.getMazeDistance(myPos, enemyPositions[oppIndex])
                 if dist < minDist:
                     minDist = dist
                     closestEnemyIndex = oppIndex
-        self.agentAndEnemiesIndices = [self.index, closestEnemyIndex]
+        self.setSearchedAgents(gameState, closestEnemyIndex)
         # End of updating closest enemy index
         
         self.updateScared(gameState, prevState)
 
-        successors = [self.getSuccessor(gameState, action, self.index) for action in legalMoves]
-        scores = []
-        # Simulate our agent acting by first looking at a successor
-        # start ABPruning at 1 to simulate enemy agents acting after our agent "acts"
-        for successor in successors:
-            scores.append(self.ABPrune(successor, self.depth, 1, self.startAlpha, self.startBeta))
-        bestScore = max(scores)
-        # explanation: a at start means don't change the value of the retrieved item;
-        # and only retrieve items that have max value
-        bestActions = [a for a, s in zip(legalMoves, scores) if s == bestScore]
+        bestActions = self.searchRoot(gameState, legalMoves)
         return random.choice(bestActions)
 
-    def evaluate(self, gameState):
+    def getRolloutTarget(self, state):
+        """
+        Rollouts chase the nearest invader, or the nearest enemy when there's none.
+        """
+        myCell = state.positions[self.index]
+        enemies = [opp for opp in self.turn.opponents if state.isPacman(opp)]
+        if len(enemies) == 0:
+            enemies = self.turn.opponents
+        return min((state.positions[opp] for opp in enemies),
+                key = lambda cell: self.distanceTable.getDistanceById(myCell, cell))
+
+    def evaluate(self, state):
         """
         Look ahead agents evaluate future states, not actions from the
         current state.
         Computes a linear combination of features and feature weights.
         """
-        return self.defensiveEval(gameState)
+        return self.defensiveEval(state)
     
-    def defensiveEval(self, gameState):
-        
-        features = {
-            'distanceToEnemies': 0
-        }
-        weights = {
-            'distanceToEnemies': 1,
-            'distanceToInvader': 100,
-            'onDefense': 1,
-            'numInvaders': -1000,
-            'frozen': 0,
-            'alive': 10,
-            'distanceBetweenEnemyAndFood': 100
-        }
+    def defensiveEval(self, state):
+        slots = self.evaluator.slots
+        features = self.evaluator.newFeatures()
         # idea: defensive should be able to hunt down nearby scared ghosts
 
-        myState = gameState.getAgentState(self.index)
-        myPos = gameState.getAgentState(self.index).getPosition()
-        prevState = self.getPreviousObservation()
-        prevPos = None
-        if prevState is not None:
-            prevPos = prevState.getAgentState(self.index).getPosition()
+        turn = self.turn
+        myPos = state.getAgentPosition(self.index)
+        prevPos = turn.prevPos
+        if prevPos is not None:
             if (myPos == prevPos):
-                features['frozen'] = 1  # disincentivize freezing up
+                features[slots.frozen] = 1  # disincentivize freezing up
 
-        features['onDefense'] = 1
-        if (myState.isPacman()):
-            features['onDefense'] = 0
+        features[slots.onDefense] = 1
+        if (state.isPacman(self.index)):
+            features[slots.onDefense] = 0
         
         if prevPos is not None:
-            killed = prevPos != myPos and myPos == self.startPos
-            features['alive'] = 1
+            killed = prevPos != myPos and myPos == turn.startPos
+            features[slots.alive] = 1
             if killed:
-                features['alive'] = 0
+                features[slots.alive] = 0
 
-        enemies = [gameState.getAgentState(i) for i in self.getOpponents(gameState)]
-        foodList = self.getFood(gameState).asList()
+        enemyPositions = [state.getAgentPosition(opp) for opp in turn.opponents]
         
         # maximize distance between enemy and food
-        features['distanceBetweenEnemyAndFood'] = 0
-        for enemy in enemies:
-            if (len(foodList) > 0):
-                minDistance = min([self.getMazeDistance(enemy.getPosition(), food)
-                    for food in foodList])
-                features['distanceBetweenEnemyAndFood'] += minDistance
-
-        invaders = [a for a in enemies if a.isPacman() and a.getPosition() is not None]
-        features['numInvaders'] = len(invaders)
-        features['distanceToEnemies'] = 0
-        features['distanceToInvader'] = 0
+        features[slots.distanceBetweenEnemyAndFood] = 0
+        for enemyPos in enemyPositions:
+            minDistance = self.nearestFoodDistance(state, enemyPos)
+            if minDistance is not None:
+                features[slots.distanceBetweenEnemyAndFood] += minDistance
+
+        invaders = [opp for opp in turn.opponents if state.isPacman(opp)]
+        features[slots.numInvaders] = len(invaders)
+        features[slots.distanceToEnemies] = 0
+        features[slots.distanceToInvader] = 0
         if (len(invaders) > 0):  # if there's an invader, they take priority
-            dists = [self.getMazeDistance(myPos, a.getPosition()) for a in invaders]
-            features['distanceToInvader'] = 1 / (min(dists) + 1)
+            dists = [self.getMazeDistance(myPos, state.getAgentPosition(opp)) for opp in invaders]
+            features[slots.distanceToInvader] = 1 / (min(dists) + 1)
             # incentivize agent to reduce the number of invaders by eating them
         else:  # minimize distance between both enemies
-            dists = [self.getMazeDistance(myPos, a.getPosition()) for a in enemies]
+            dists = [self.getMazeDistance(myPos, enemyPos) for enemyPos in enemyPositions]
             denom = 1
             # squaring the distances means that equalizing the distances gives higher score
             for dist in dists:
                 denom += dist**2
-            features['distanceToEnemies'] = 1 / denom
+            features[slots.distanceToEnemies] = 1 / denom
 
-        stateEval = sum(features[feature] * weights[feature] for feature in features)
-        return stateEval
+        return self.evaluator.score(features)
         
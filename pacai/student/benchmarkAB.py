@@ -0,0 +1,320 @@
+"""
+Offline benchmark for our capture teams.
+
+Recording a corpus: play games with this module as a team, telling it which team to wrap,
+e.g. `--red pacai.student.benchmarkAB --redOpts team=pacai.student.ABImprovedv4,corpus=corpus.pkl`.
+Every `every`-th move each wrapped agent sees is saved (with the game's initial state and
+the previous observation) and the corpus file is appended to when the game ends.
+
+Replaying it: `python -m pacai.student.benchmarkAB corpus.pkl --out report.json` runs every
+saved position through each team's chooseAction and writes a JSON report with wall time,
+nodes expanded, leaves evaluated, successors generated and peak memory per move.
+Runs headless, seeds `random` before every move, and turns off time-budgeted search
+(unless --timed) so the numbers are repeatable.
+A team can be given createTeam options after its module, e.g.
+`--teams pacai.student.ABImprovedv4,pacai.student.ABImprovedv4:engine=mcts --timed`
+compares our AB and MCTS engines on the same positions under the same time budget.
+Options starting with `@` set an attribute on the agent after it registers instead, e.g.
+`--teams pacai.student.ABImprovedv4,pacai.student.ABImprovedv4:@useMoveOrdering=false`
+measures what move ordering saves.
+
+`--validate DEPTH` checks teams that search on SearchStates (see searchState.py) against
+the real game first: from every saved position every move of every agent, DEPTH plies deep,
+is played with both generateSuccessor and SearchState.apply and has to give the same state.
+"""
+
+import argparse
+import copy
+import json
+import os
+import pickle
+import random
+import sys
+import time
+import tracemalloc
+
+from pacai.student.searchState import validateSearchState
+from pacai.util import reflection
+
+DEFAULT_TEAMS = [
+    'pacai.student.ABImprovedTeam',
+    'pacai.student.ABImprovedv2',
+    'pacai.student.ABImprovedv3',
+    'pacai.student.ABImprovedv4',
+    'pacai.student.foodClustersPHX',
+]
+
+def createTeam(firstIndex, secondIndex, isRed,
+        team = 'pacai.student.ABImprovedv4',
+        corpus = 'corpus.pkl',
+        every = '10'):
+    """
+    Builds `team` as usual and wraps both of its agents so they record positions to `corpus`.
+    """
+
+    createInnerTeam = reflection.qualifiedImport(team + '.createTeam')
+    agents = createInnerTeam(firstIndex, secondIndex, isRed)
+
+    return [
+        RecordingAgent(agents[0], 0, (firstIndex, secondIndex), isRed, corpus, int(every)),
+        RecordingAgent(agents[1], 1, (firstIndex, secondIndex), isRed, corpus, int(every)),
+    ]
+
+class RecordingAgent(object):
+    """
+    Passes everything through to the wrapped agent, saving every `every`-th position it is
+    asked to move in.
+    """
+
+    def __init__(self, agent, role, teamIndices, isRed, corpus, every):
+        self.agent = agent
+        self.role = role
+        self.teamIndices = teamIndices
+        self.isRed = isRed
+        self.corpus = corpus
+        self.every = every
+        self.initialState = None
+        self.previousState = None
+        self.moves = 0
+        self.records = []
+
+    def __getattr__(self, name):
+        return getattr(self.agent, name)
+
+    def registerInitialState(self, gameState):
+        self.initialState = gameState
+        self.agent.registerInitialState(gameState)
+
+    def getAction(self, gameState):
+        if self.moves % self.every == 0:
+            self.records.append({
+                'role': self.role,
+                'index': self.agent.index,
+                'teamIndices': self.teamIndices,
+                'isRed': self.isRed,
+                'initialState': self.initialState,
+                'previousState': self.previousState,
+                'gameState': gameState,
+            })
+        self.moves += 1
+        self.previousState = gameState
+        return self.agent.getAction(gameState)
+
+    def final(self, gameState):
+        if hasattr(self.agent, 'final'):
+            self.agent.final(gameState)
+        if len(self.records) > 0:
+            saveCorpus(self.corpus, loadCorpus(self.corpus) + self.records)
+            self.records = []
+
+def loadCorpus(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, 'rb') as corpusFile:
+        return pickle.load(corpusFile)
+
+def saveCorpus(path, records):
+    with open(path, 'wb') as corpusFile:
+        pickle.dump(records, corpusFile)
+
+class MoveCounters(object):
+    """
+    Counts ABPrune calls, evaluations and successor generations (getSuccessor, or makeMove
+    in engines that make and unmake moves) on one agent instance by shadowing those methods
+    with counting wrappers. The search calls them through `self`,
+    so this works on every version of our AB agents without touching their code.
+    Agents searching with MCTS count an iteration (one playout) as a node.
+    """
+
+    def __init__(self, agent):
+        self.nodes = 0
+        self.leaves = 0
+        self.successors = 0
+        self.wrap(agent, 'ABPrune', 'nodes')
+        self.wrap(agent, 'evaluate', 'leaves')
+        self.wrap(agent, 'getSuccessor', 'successors')
+        self.wrap(agent, 'makeMove', 'successors')
+        if getattr(agent, 'searchEngine', None) == 'mcts':
+            self.wrap(agent.monteCarlo, 'runIteration', 'nodes')
+
+    def wrap(self, agent, methodName, counterName):
+        method = getattr(agent, methodName, None)
+        if method is None:
+            return
+
+        def counted(*args, **kwargs):
+            setattr(self, counterName, getattr(self, counterName) + 1)
+            return method(*args, **kwargs)
+
+        setattr(agent, methodName, counted)
+
+def parseTeam(teamName):
+    """
+    Splits `module:key=value:@name=value` into the module, its createTeam options and
+    the agent attributes to set after registering. Attribute values are read as JSON
+    (true, 3, 0.5, ...) when they parse as such, and kept as strings otherwise.
+    """
+    parts = teamName.split(':')
+    options = {}
+    attributes = {}
+    for option in parts[1:]:
+        key, value = option.split('=', 1)
+        if key.startswith('@'):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                pass
+            attributes[key[1:]] = value
+        else:
+            options[key] = value
+    return parts[0], options, attributes
+
+def prepareAgent(teamName, record, prototypes, timed):
+    """
+    A fresh copy of the team's agent for the record's role, already registered with the
+    record's game. Registering (distance tables etc.) is done once per team and game.
+    """
+    key = (teamName, id(record['initialState']), record['role'])
+    if key not in prototypes:
+        moduleName, options, attributes = parseTeam(teamName)
+        createTeam = reflection.qualifiedImport(moduleName + '.createTeam')
+        firstIndex, secondIndex = record['teamIndices']
+        agent = createTeam(firstIndex, secondIndex, record['isRed'], **options)[record['role']]
+        agent.registerInitialState(record['initialState'])
+        for name, value in attributes.items():
+            setattr(agent, name, value)
+        # worker pools and shared memory can't be copied, and serial search is repeatable
+        if hasattr(agent, 'stopSearchPool'):
+            agent.stopSearchPool()
+        prototypes[key] = agent
+    agent = copy.deepcopy(prototypes[key])
+    if not timed and hasattr(agent, 'iterativeDeepening'):
+        agent.iterativeDeepening = False
+    return agent
+
+def benchmarkMove(agent, record, seed, measureMemory):
+    """
+    Runs chooseAction on one saved position the way the game's getAction would.
+    """
+    if record['previousState'] is not None:
+        agent.observationHistory.append(record['previousState'])
+    agent.observationHistory.append(record['gameState'])
+    # copied before the counters go on, they would point the copy back at this agent
+    memoryAgent = copy.deepcopy(agent) if measureMemory else None
+    counters = MoveCounters(agent)
+
+    random.seed(seed)
+    startTime = time.perf_counter()
+    action = agent.chooseAction(record['gameState'])
+    wallTime = time.perf_counter() - startTime
+
+    result = {
+        'action': action,
+        'wallTime': wallTime,
+        'nodes': counters.nodes,
+        'leaves': counters.leaves,
+        'successors': counters.successors,
+        'peakMemory': None,
+    }
+
+    if measureMemory:
+        # tracemalloc slows everything down, so memory gets its own run on a fresh copy
+        random.seed(seed)
+        tracemalloc.start()
+        memoryAgent.chooseAction(record['gameState'])
+        result['peakMemory'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return result
+
+def summarize(moves):
+    wallTimes = [move['wallTime'] for move in moves]
+    summary = {
+        'moves': len(moves),
+        'meanWallTime': sum(wallTimes) / len(wallTimes),
+        'maxWallTime': max(wallTimes),
+    }
+    for name in ('nodes', 'leaves', 'successors', 'peakMemory'):
+        values = [move[name] for move in moves if move[name] is not None]
+        if len(values) > 0:
+            summary['mean' + name[0].upper() + name[1:]] = sum(values) / len(values)
+            summary['max' + name[0].upper() + name[1:]] = max(values)
+    return summary
+
+def validateCorpus(records, teams, depth):
+    """
+    Runs validateSearchState from every saved position for each team whose agents keep
+    SearchRules. Raises ValueError on the first difference from the real game.
+    Returns the number of positions checked per team.
+    """
+    checked = {}
+    for teamName in teams:
+        prototypes = {}
+        checked[teamName] = 0
+        for record in records:
+            agent = prepareAgent(teamName, record, prototypes, False)
+            if getattr(agent, 'searchRules', None) is None:
+                break
+            validateSearchState(agent.searchRules, record['gameState'], depth)
+            checked[teamName] += 1
+    return checked
+
+def runBenchmark(records, teams, seed = 0, measureMemory = True, timed = False):
+    report = {
+        'seed': seed,
+        'timed': timed,
+        'positions': len(records),
+        'teams': {},
+    }
+    for teamName in teams:
+        prototypes = {}
+        moves = []
+        for position, record in enumerate(records):
+            agent = prepareAgent(teamName, record, prototypes, timed)
+            move = benchmarkMove(agent, record, seed + position, measureMemory)
+            move['position'] = position
+            move['role'] = record['role']
+            moves.append(move)
+        report['teams'][teamName] = {
+            'summary': summarize(moves),
+            'moves': moves,
+        }
+    return report
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+            description = 'Benchmark our capture teams on saved positions.')
+    parser.add_argument('corpus', help = 'corpus file written by the recording team')
+    parser.add_argument('--teams', default = ','.join(DEFAULT_TEAMS),
+            help = 'comma separated team modules to benchmark')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--no-memory', dest = 'memory', action = 'store_false',
+            help = 'skip the (slow) peak memory runs')
+    parser.add_argument('--timed', action = 'store_true',
+            help = 'keep time-budgeted iterative deepening on (results will vary between runs)')
+    parser.add_argument('--out', default = None, help = 'write the JSON report here')
+    parser.add_argument('--validate', type = int, default = 0, metavar = 'DEPTH',
+            help = 'first check search states against the game rules, DEPTH plies deep')
+    options = parser.parse_args(argv)
+
+    records = loadCorpus(options.corpus)
+    if len(records) == 0:
+        raise ValueError('No positions in corpus: %s' % (options.corpus))
+
+    if options.validate > 0:
+        checked = validateCorpus(records, options.teams.split(','), options.validate)
+        for teamName, count in checked.items():
+            print('%s: %d positions match the game rules' % (teamName, count),
+                    file = sys.stderr)
+
+    report = runBenchmark(records, options.teams.split(','), options.seed,
+            options.memory, options.timed)
+    output = json.dumps(report, indent = 4)
+    if options.out is None:
+        print(output)
+    else:
+        with open(options.out, 'w') as reportFile:
+            reportFile.write(output)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
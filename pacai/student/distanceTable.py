@@ -0,0 +1,258 @@
+import heapq
+import logging
+import time
+from array import array
+from collections import deque
+from multiprocessing import shared_memory
+
+# Stored for cell pairs with no path between them (e.g. sealed off pockets of the layout).
+UNREACHABLE = 0xFFFF
+
+class MazeDistanceTable(object):
+    """
+    All-pairs maze distances over the walkable cells of a layout.
+    Every walkable cell gets an integer id, and the distance between cells i and j
+    is stored at i * numCells + j of one flat array of unsigned shorts,
+    instead of a dict keyed on pairs of position tuples.
+    Built once per game (a BFS from every cell), after that a lookup is two dict gets
+    and an array index.
+    """
+
+    def __init__(self, walls):
+        startTime = time.time()
+
+        self.cells = []
+        for x in range(walls.width):
+            for y in range(walls.height):
+                if not walls[x][y]:
+                    self.cells.append((x, y))
+        self.cellIds = {cell: cellId for cellId, cell in enumerate(self.cells)}
+        self.numCells = len(self.cells)
+
+        # walkable neighbours of every cell, by id
+        self.neighbors = []
+        for x, y in self.cells:
+            cellNeighbors = []
+            for neighbor in ((x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)):
+                if neighbor in self.cellIds:
+                    cellNeighbors.append(self.cellIds[neighbor])
+            self.neighbors.append(cellNeighbors)
+
+        self.distances = array('H', [UNREACHABLE]) * (self.numCells * self.numCells)
+        for source in range(self.numCells):
+            self.fillRow(source)
+
+        # set when the distances live in a shared memory block (see share)
+        self.sharedBlock = None
+        self.sharedName = None
+        self.ownsSharedBlock = False
+
+        self.buildTime = time.time() - startTime
+        logging.debug('Built maze distance table for %d cells in %.3fs (%d KB)'
+                % (self.numCells, self.buildTime, self.getMemoryUsage() // 1024))
+
+    def fillRow(self, source):
+        """
+        BFS out from one cell, writing its distance to every other cell.
+        """
+        distances = self.distances
+        neighbors = self.neighbors
+        offset = source * self.numCells
+        distances[offset + source] = 0
+        queue = deque([source])
+        while queue:
+            cell = queue.popleft()
+            nextDistance = distances[offset + cell] + 1
+            for neighbor in neighbors[cell]:
+                if distances[offset + neighbor] == UNREACHABLE:
+                    distances[offset + neighbor] = nextDistance
+                    queue.append(neighbor)
+
+    def getCellId(self, pos):
+        """
+        The id of the cell at `pos`. Positions in the middle of a move
+        are rounded to the nearest cell.
+        """
+        cellId = self.cellIds.get(pos)
+        if cellId is None:
+            cellId = self.cellIds[(int(pos[0] + 0.5), int(pos[1] + 0.5))]
+        return cellId
+
+    def getDistance(self, pos1, pos2):
+        return self.distances[self.getCellId(pos1) * self.numCells + self.getCellId(pos2)]
+
+    def getDistanceById(self, cellId1, cellId2):
+        return self.distances[cellId1 * self.numCells + cellId2]
+
+    def getDiameter(self):
+        """
+        The longest maze distance between two cells that are connected.
+        """
+        return max(distance for distance in self.distances if distance != UNREACHABLE)
+
+    def getMemoryUsage(self):
+        """
+        Bytes used by the distance array.
+        """
+        return self.distances.itemsize * len(self.distances)
+
+    def share(self):
+        """
+        Moves the distance array into a shared memory block.
+        From then on pickling the table (e.g. to send it to a worker process) only sends
+        the block's name, and the other process reads the same memory without a copy.
+        """
+        if self.sharedBlock is not None:
+            return
+        size = self.getMemoryUsage()
+        block = shared_memory.SharedMemory(create = True, size = size)
+        block.buf[:size] = self.distances.tobytes()
+        self.attachSharedBlock(block)
+        self.ownsSharedBlock = True
+
+    def unshare(self):
+        """
+        Copies the distances back into private memory and lets go of the shared block,
+        freeing it if we created it.
+        """
+        if self.sharedBlock is None:
+            return
+        distances = array('H', self.distances)
+        self.distances.release()
+        self.sharedView.release()
+        self.sharedBlock.close()
+        if self.ownsSharedBlock:
+            self.sharedBlock.unlink()
+        self.distances = distances
+        self.sharedBlock = None
+        self.sharedName = None
+        self.ownsSharedBlock = False
+
+    def __del__(self):
+        # the block can only be closed once our views into it are gone
+        if getattr(self, 'sharedBlock', None) is not None:
+            self.distances.release()
+            self.sharedView.release()
+
+    def attachSharedBlock(self, block):
+        self.sharedBlock = block
+        self.sharedName = block.name
+        self.sharedView = block.buf[:self.numCells * self.numCells * 2]
+        self.distances = self.sharedView.cast('H')
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.sharedBlock is not None:
+            # the receiving process attaches to the block by name instead
+            del state['distances']
+            del state['sharedView']
+            state['sharedBlock'] = None
+            state['ownsSharedBlock'] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.sharedName is not None:
+            self.attachSharedBlock(shared_memory.SharedMemory(name = self.sharedName))
+
+class DistanceField(object):
+    """
+    Distance from every walkable cell to the nearest of a set of source cells
+    (remaining food, capsules, ...), from one multi-source BFS.
+    We also remember which source each cell is closest to, so when a source disappears
+    (a simulated agent eats the dot) only the cells that source owned are repaired.
+    Fields are immutable, `without` hands back a repaired copy and memoizes it,
+    so every leaf of a search that ate the same dots shares one field.
+    """
+
+    def __init__(self, table, sources, distances = None, owners = None):
+        self.table = table
+        self.sources = frozenset(sources)
+        self.children = {}
+        if distances is not None:
+            self.distances = distances
+            self.owners = owners
+            return
+
+        self.distances = array('H', [UNREACHABLE]) * table.numCells
+        self.owners = array('i', [-1]) * table.numCells
+        queue = deque()
+        for source in self.sources:
+            self.distances[source] = 0
+            self.owners[source] = source
+            queue.append(source)
+        while queue:
+            cell = queue.popleft()
+            nextDistance = self.distances[cell] + 1
+            for neighbor in table.neighbors[cell]:
+                if self.distances[neighbor] == UNREACHABLE:
+                    self.distances[neighbor] = nextDistance
+                    self.owners[neighbor] = self.owners[cell]
+                    queue.append(neighbor)
+
+    def getDistance(self, pos):
+        """
+        Maze distance from `pos` to the nearest source, or None if there are no sources.
+        """
+        distance = self.distances[self.table.getCellId(pos)]
+        if distance == UNREACHABLE:
+            return None
+        return distance
+
+    def getOwner(self, pos):
+        """
+        Cell id of the source nearest to `pos`, or None if there are no sources.
+        """
+        owner = self.owners[self.table.getCellId(pos)]
+        if owner < 0:
+            return None
+        return owner
+
+    def without(self, source):
+        """
+        This field with `source` removed.
+        Only the cells that `source` owned can change, they are cleared and refilled
+        from the surrounding cells that still have an owner.
+        """
+        if source not in self.sources:
+            return self
+        child = self.children.get(source)
+        if child is not None:
+            return child
+
+        neighbors = self.table.neighbors
+        distances = self.distances[:]
+        owners = self.owners[:]
+
+        # the cells this source owned form a connected region around it
+        region = [source]
+        owners[source] = -1
+        distances[source] = UNREACHABLE
+        i = 0
+        while i < len(region):
+            for neighbor in neighbors[region[i]]:
+                if owners[neighbor] == source:
+                    owners[neighbor] = -1
+                    distances[neighbor] = UNREACHABLE
+                    region.append(neighbor)
+            i += 1
+
+        # refill the region from its border, nearest first
+        frontier = []
+        for cell in region:
+            for neighbor in neighbors[cell]:
+                if owners[neighbor] >= 0:
+                    heapq.heappush(frontier, (distances[neighbor] + 1, cell, owners[neighbor]))
+        while frontier:
+            distance, cell, owner = heapq.heappop(frontier)
+            if distance >= distances[cell]:
+                continue
+            distances[cell] = distance
+            owners[cell] = owner
+            for neighbor in neighbors[cell]:
+                if distance + 1 < distances[neighbor]:
+                    heapq.heappush(frontier, (distance + 1, neighbor, owner))
+
+        child = DistanceField(self.table, self.sources - {source}, distances, owners)
+        self.children[source] = child
+        return child
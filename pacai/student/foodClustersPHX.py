@@ -3,8 +3,94 @@ from pacai.util import reflection
 import random
 
 from pacai.agents.capture.capture import CaptureAgent
+from pacai.student.distanceTable import MazeDistanceTable
 from pacai.util import util
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Food within this many maze steps of each other count as one cluster.
+CLUSTER_RADIUS = 2
+
+class FoodClusterScorer(object):
+    """
+    Scores every food by (food within CLUSTER_RADIUS of it) / (distance to us ** 2 + 1)
+    and hands back the best score.
+    The neighbour counts only depend on which food is left, so they are computed once per
+    turn and patched one column at a time for food eaten inside the search.
+    The proximity term is one vectorized pass over the remaining food.
+    Uses NumPy when it's installed, plain lists otherwise.
+    """
+
+    def __init__(self, distanceTable, foodList):
+        self.table = distanceTable
+        self.foodCells = [(int(x), int(y)) for x, y in foodList]
+        self.foodIds = [distanceTable.getCellId(food) for food in self.foodCells]
+        # counts and remaining food for each set of eaten food we've seen, by eaten indices
+        self.counts = {}
+
+        if numpy is not None:
+            numCells = distanceTable.numCells
+            # zero copy view of the all-pairs table
+            self.allDistances = numpy.frombuffer(distanceTable.distances,
+                    dtype = numpy.uint16).reshape(numCells, numCells)
+            self.ids = numpy.array(self.foodIds, dtype = numpy.intp)
+            self.neighbors = (self.allDistances[numpy.ix_(self.ids, self.ids)]
+                    <= CLUSTER_RADIUS).astype(numpy.int32)
+            remaining = numpy.ones(len(self.foodIds), dtype = bool)
+            self.counts[()] = (self.neighbors.sum(axis = 1), remaining)
+        else:
+            self.neighbors = [[int(distanceTable.getDistanceById(i, j) <= CLUSTER_RADIUS)
+                    for j in self.foodIds] for i in self.foodIds]
+            remaining = [True] * len(self.foodIds)
+            self.counts[()] = ([sum(row) for row in self.neighbors], remaining)
+
+    def getCounts(self, eaten):
+        """
+        Neighbour counts and the remaining food mask once the food at the `eaten` indices
+        is gone, built from the counts with one less food eaten.
+        """
+        result = self.counts.get(eaten)
+        if result is not None:
+            return result
+
+        parentCounts, parentRemaining = self.getCounts(eaten[:-1])
+        last = eaten[-1]
+        if numpy is not None:
+            counts = parentCounts - self.neighbors[:, last]
+            remaining = parentRemaining.copy()
+        else:
+            counts = [count - row[last] for count, row in zip(parentCounts, self.neighbors)]
+            remaining = list(parentRemaining)
+        remaining[last] = False
+
+        result = (counts, remaining)
+        self.counts[eaten] = result
+        return result
+
+    def bestScore(self, gameState, pos):
+        """
+        Best cluster_size * proximity over the food still in `gameState`, None if none is left.
+        """
+        eaten = tuple(i for i, (x, y) in enumerate(self.foodCells) if not gameState.hasFood(x, y))
+        if len(eaten) == len(self.foodCells):
+            return None
+        counts, remaining = self.getCounts(eaten)
+        myId = self.table.getCellId(pos)
+
+        if numpy is not None:
+            distances = self.allDistances[myId, self.ids[remaining]].astype(numpy.float64)
+            return float((counts[remaining] / (distances * distances + 1)).max())
+
+        bestScore = 0
+        for i, foodId in enumerate(self.foodIds):
+            if remaining[i]:
+                distance = self.table.getDistanceById(myId, foodId)
+                bestScore = max(bestScore, counts[i] / (distance ** 2 + 1))
+        return bestScore
+
 def createTeam(firstIndex, secondIndex, isRed,
         first = 'pacai.agents.capture.custom.AttackAgent',
         second = 'pacai.agents.capture.custom.DefenseAgent'):
@@ -39,6 +125,8 @@ class ABPruningCaptureAgent(CaptureAgent):
         such as the team the agent is on and the `pacai.core.distanceCalculator.Distancer`.
         """
         super().registerInitialState(gameState)
+        # All-pairs maze distances, read by getMazeDistance for the rest of the game
+        self.distanceTable = MazeDistanceTable(gameState.getWalls())
 
         # Initialize a list that can be accessed by the agent later
         # Consisting of itself and its two opponents
@@ -54,6 +142,12 @@ class ABPruningCaptureAgent(CaptureAgent):
         self.startBeta = float('inf')
         self.totalTime = gameState.getTimeleft()
 
+    def getMazeDistance(self, pos1, pos2):
+        """
+        Reads maze distances from our precomputed distance table.
+        """
+        return self.distanceTable.getDistance(pos1, pos2)
+
     def chooseAction(self, gameState):
         """
         Use AB pruning to find the best action.
@@ -179,6 +273,9 @@ class OffensiveABAgent(ABPruningCaptureAgent):
         self.agentAndEnemiesIndices = [self.index, closestEnemyIndex]
         # End of updating closest enemy index
 
+        # food clusters are scored from this turn's food at every leaf
+        self.foodClusters = FoodClusterScorer(self.distanceTable, self.getFood(gameState).asList())
+
         successors = [self.getSuccessor(gameState, action, self.index) for action in legalMoves]
         scores = []
         # Simulate our agent acting by first looking at a successor
@@ -229,21 +326,9 @@ class OffensiveABAgent(ABPruningCaptureAgent):
         # allies = [gameState.getAgentState(i) for i in self.getTeam(gameState) if i != self.index]
         enemies = [gameState.getAgentState(i) for i in self.getOpponents(gameState)]
         ghosts = [a for a in enemies if not a.isPacman() and a.getPosition() is not None]
-        # Compute distance to the nearest food.
-        foodList = self.getFood(gameState).asList()
-
-        def score_food(foodList, myPos):
-            food_scores = []
-            cluster_radius = 2
-            for food in foodList:
-                cluster_size = sum(1 for food2 in foodList if self.getMazeDistance(food, food2) <= cluster_radius)
-                distance_to_pacman = self.getMazeDistance(myPos, food)
-                proximity = 1 / (distance_to_pacman ** 2 + 1)
-                total_score = cluster_size * proximity
-                food_scores.append(total_score)
-            return max(food_scores)
-        if (len(foodList) > 0):
-            best_food_score = score_food(foodList, myPos)
+        # Score food by how big its cluster is and how close it is.
+        best_food_score = self.foodClusters.bestScore(gameState, myPos)
+        if best_food_score is not None:
             features['distanceToFood'] = 1 / best_food_score**2 + 1
         
         capsuleList = self.getCapsules(gameState)
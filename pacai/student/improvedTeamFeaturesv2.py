@@ -1,6 +1,7 @@
 from pacai.util import reflection
 from pacai.agents.capture.reflex import ReflexCaptureAgent
 from pacai.core.directions import Directions
+from pacai.student.distanceTable import MazeDistanceTable
 
 def createTeam(firstIndex, secondIndex, isRed,
         first = 'pacai.student.myTeam.UpdatedAttackAgent',
@@ -30,9 +31,31 @@ class UpdatedAttackAgent(ReflexCaptureAgent):
     but it is by no means the best or only way to build an offensive agent.
     """
 
+    WEIGHTS = {
+        'stop': .001,
+        'reverse': .001,
+        'successorScore': 2.000,
+        'invaderDistance': -1.000,
+        'distanceToAlly': .100,
+        'bestFoodItem': -0.125,
+        'eatCapsule': -0.250,
+        'dontEatCapsule': 0.050
+    }
+
     def __init__(self, index, **kwargs):
         super().__init__(index)
 
+    def registerInitialState(self, gameState):
+        super().registerInitialState(gameState)
+        # All-pairs maze distances, read by getMazeDistance for the rest of the game
+        self.distanceTable = MazeDistanceTable(gameState.getWalls())
+
+    def getMazeDistance(self, pos1, pos2):
+        """
+        Reads maze distances from our precomputed distance table.
+        """
+        return self.distanceTable.getDistance(pos1, pos2)
+
     def getFeatures(self, gameState, action):
         # Defines agent priorities
         # Other things offensive agent could care about:
@@ -126,16 +149,8 @@ class UpdatedAttackAgent(ReflexCaptureAgent):
         return features
 
     def getWeights(self, gameState, action):
-        return {
-            'stop': .001,
-            'reverse': .001,
-            'successorScore': 2.000,
-            'invaderDistance': -1.000,
-            'distanceToAlly': .100,
-            'bestFoodItem': -0.125,
-            'eatCapsule': -0.250,
-            'dontEatCapsule': 0.050
-        }
+        # constant, so built once for the class instead of on every call
+        return self.WEIGHTS
 
 class UpdatedDefenseAgent(ReflexCaptureAgent):
     """
@@ -144,9 +159,30 @@ class UpdatedDefenseAgent(ReflexCaptureAgent):
     It is not the best or only way to make such an agent.
     """
 
+    WEIGHTS = {
+        'stop': .1,
+        'reverse': -0.002,
+        'successorScore': 3.000,
+        'distanceToAlly': .100,
+        'bestFoodItem': -0.125,
+        'dodgeGhost': 0.500,
+        'invaderDistance': -1.000,
+    }
+
     def __init__(self, index, **kwargs):
         super().__init__(index)
 
+    def registerInitialState(self, gameState):
+        super().registerInitialState(gameState)
+        # All-pairs maze distances, read by getMazeDistance for the rest of the game
+        self.distanceTable = MazeDistanceTable(gameState.getWalls())
+
+    def getMazeDistance(self, pos1, pos2):
+        """
+        Reads maze distances from our precomputed distance table.
+        """
+        return self.distanceTable.getDistance(pos1, pos2)
+
     def getFeatures(self, gameState, action):
         features = {}
         
@@ -229,12 +265,5 @@ class UpdatedDefenseAgent(ReflexCaptureAgent):
         return features
 
     def getWeights(self, gameState, action):
-        return {
-            'stop': .1,
-            'reverse': -0.002,
-            'successorScore': 3.000,
-            'distanceToAlly': .100,
-            'bestFoodItem': -0.125,
-            'dodgeGhost': 0.500,
-            'invaderDistance': -1.000,
-        }
\ No newline at end of file
+        # constant, so built once for the class instead of on every call
+        return self.WEIGHTS
\ No newline at end of file
@@ -0,0 +1,237 @@
+import math
+import random
+import time
+
+# UCT exploration constant, for node values scaled to [0, 1] over the values seen so far.
+EXPLORATION = math.sqrt(2)
+# Rounds (one move by every searched agent) a rollout plays past the tree before it is
+# cut off with the agent's evaluation.
+ROLLOUT_ROUNDS = 3
+# Chance a rollout move is the mover's greedy step rather than a random move.
+ROLLOUT_GREEDY_RATE = 0.8
+# Iterations per move when we're not searching against the clock (repeatable runs).
+FIXED_ITERATIONS = 2000
+
+class MonteCarloNode(object):
+    """
+    One position in the search tree. Values are totals of our evaluation over every
+    playout through the node, whichever agent is to move in it.
+    Every node remembers the cell of the agent to move, and nodes where it's our turn
+    again the cells of all the searched agents, that's what the tree is matched on when
+    it's reused next turn.
+    """
+
+    __slots__ = ('cell', 'children', 'untried', 'visits', 'total', 'signature')
+
+    def __init__(self, cell, legalMoves, signature = None):
+        self.visits = 0
+        self.total = 0.0
+        self.signature = signature
+        self.expandFrom(cell, legalMoves)
+
+    def expandFrom(self, cell, legalMoves):
+        """
+        Forgets the node's children, its mover is at `cell` with `legalMoves` to try.
+        """
+        self.cell = cell
+        self.children = {}
+        self.untried = list(legalMoves)
+        random.shuffle(self.untried)
+
+class MonteCarloTreeSearch(object):
+    """
+    UCT search over the agent's SearchStates, taking turns between the agents of
+    `agent.agentAndEnemiesIndices` like ABPrune does: we pick the move with the best upper
+    confidence bound on our value, enemies the one with the best bound on theirs.
+    Each iteration walks down the tree, adds one node, plays a short cheap rollout from it
+    and backs the agent's evaluation of where the rollout ended up all the way up.
+    It's anytime: stop it whenever and the most visited root move is the answer.
+    The tree below the position we end up in next turn is kept and searched on from there.
+    """
+
+    def __init__(self, agent):
+        self.agent = agent
+        self.root = None
+        self.indices = None
+        self.policyAgents = None
+        self.lowValue = float('inf')
+        self.highValue = float('-inf')
+        self.iterations = 0
+        self.reused = False
+
+    def search(self, rootState, legalMoves, deadline = None, iterations = FIXED_ITERATIONS):
+        """
+        Searches until `deadline` (time.time()), or for `iterations` iterations without one.
+        Every root move is tried at least once either way.
+        Returns the root moves tied for the most visits.
+        """
+        indices = list(self.agent.agentAndEnemiesIndices)
+        policyAgents = self.agent.turn.policyAgents
+        self.root = self.findReusableRoot(rootState, indices, policyAgents)
+        self.reused = self.root is not None
+        if self.root is None:
+            # a reused tree keeps the value range its values were backed up over
+            self.root = MonteCarloNode(rootState.positions[indices[0]], legalMoves)
+            self.lowValue = float('inf')
+            self.highValue = float('-inf')
+        self.indices = indices
+        self.policyAgents = policyAgents
+
+        self.iterations = 0
+        while len(self.root.untried) > 0 or (deadline is None and self.iterations < iterations) \
+                or (deadline is not None and time.time() < deadline):
+            self.runIteration(rootState)
+            self.iterations += 1
+
+        mostVisits = max(child.visits for child in self.root.children.values())
+        return [action for action, child in self.root.children.items()
+                if child.visits == mostVisits]
+
+    def findReusableRoot(self, rootState, indices, policyAgents):
+        """
+        The node one round below last turn's root whose searched agents stand where they
+        stand now, or None. The same enemies have to play their policy move as last turn
+        too, the nodes' children were made for them (see getTreeMoves).
+        Our teammate and any enemy we didn't search have moved as well, so the subtree's
+        values are close to right rather than exact, and deeper down some of it may not be
+        reachable any more (see runIteration).
+        """
+        if self.root is None or indices != self.indices or policyAgents != self.policyAgents:
+            return None
+        signature = self.getSignature(rootState, indices)
+        nodes = [self.root]
+        for i in range(len(indices)):
+            nodes = [child for node in nodes for child in node.children.values()]
+        for node in nodes:
+            if node.signature == signature and node.cell == signature[0]:
+                return node
+        return None
+
+    def getSignature(self, state, indices):
+        return tuple(state.positions[index] for index in indices)
+
+    def runIteration(self, state):
+        agent = self.agent
+        indices = self.indices
+        node = self.root
+        path = [node]
+        turn = 0
+
+        # selection, down through fully expanded nodes
+        while len(node.untried) == 0 and len(node.children) > 0:
+            action, node = self.select(node, turn == 0)
+            agent.makeMove(state, action, indices[turn])
+            turn = (turn + 1) % len(indices)
+            path.append(node)
+            # in a reused tree an agent we don't search can change where a move leads
+            # (by eating or getting eaten), the node's moves are then tried again
+            cell = state.positions[indices[turn]]
+            if cell != node.cell:
+                node.expandFrom(cell, self.getTreeMoves(state, indices[turn]))
+                if turn == 0:
+                    node.signature = self.getSignature(state, indices)
+
+        # expansion, one new node per iteration
+        if len(node.untried) > 0:
+            action = node.untried.pop()
+            agent.makeMove(state, action, indices[turn])
+            turn = (turn + 1) % len(indices)
+            signature = None
+            if turn == 0:
+                signature = self.getSignature(state, indices)
+            child = MonteCarloNode(state.positions[indices[turn]],
+                    self.getTreeMoves(state, indices[turn]), signature)
+            node.children[action] = child
+            path.append(child)
+        agent.nodesSearched += len(path)
+
+        value = self.rollout(state, turn)
+        for i in range(len(path) - 1):
+            agent.unmakeMove(state)
+
+        self.lowValue = min(self.lowValue, value)
+        self.highValue = max(self.highValue, value)
+        for node in path:
+            node.visits += 1
+            node.total += value
+
+    def getTreeMoves(self, state, index):
+        """
+        The moves a node branches on: all legal ones, or just the policy move of an enemy
+        the agent doesn't search (see setSearchedAgents).
+        """
+        if index in self.agent.turn.policyAgents:
+            return [self.agent.getPolicyMove(state, index)]
+        return state.getLegalActions(index)
+
+    def select(self, node, maximizing):
+        """
+        The child with the best upper confidence bound for whoever is to move.
+        Means are scaled to [0, 1] over the values seen this search, since our evaluation
+        has no fixed range.
+        """
+        spread = self.highValue - self.lowValue
+        if spread <= 0:
+            spread = 1
+        logVisits = math.log(node.visits)
+        bestScore = float('-inf')
+        best = None
+        for action, child in node.children.items():
+            mean = (child.total / child.visits - self.lowValue) / spread
+            if not maximizing:
+                mean = 1 - mean
+            score = mean + EXPLORATION * math.sqrt(logVisits / child.visits)
+            if score > bestScore:
+                bestScore = score
+                best = (action, child)
+        return best
+
+    def rollout(self, state, turn):
+        """
+        Plays ROLLOUT_ROUNDS rounds of cheap moves, evaluates where they ended up and
+        takes them back.
+        """
+        agent = self.agent
+        indices = self.indices
+        moves = 0
+        for i in range(ROLLOUT_ROUNDS * len(indices)):
+            index = indices[turn]
+            agent.makeMove(state, self.rolloutMove(state, index), index)
+            moves += 1
+            turn = (turn + 1) % len(indices)
+        value = agent.evaluate(state)
+        for i in range(moves):
+            agent.unmakeMove(state)
+        return value
+
+    def rolloutMove(self, state, index):
+        """
+        Mostly a greedy step towards the mover's target, sometimes a random move so the
+        rollouts through a node don't all play out the same way.
+        We head for the agent's getRolloutTarget, enemy ghosts that could eat our pacman
+        chase it, and everything else moves at random.
+        """
+        legalMoves = state.getLegalActions(index)
+        if random.random() >= ROLLOUT_GREEDY_RATE:
+            return random.choice(legalMoves)
+
+        agent = self.agent
+        target = None
+        if index == agent.index:
+            target = agent.getRolloutTarget(state)
+        elif (state.isPacman(agent.index) and not state.isPacman(index)
+                and state.getScaredTimer(index) == 0):
+            target = state.positions[agent.index]
+        if target is None:
+            return random.choice(legalMoves)
+
+        table = agent.distanceTable
+        moves = state.rules.moves[state.positions[index]]
+        return min(legalMoves, key = lambda action: table.getDistanceById(moves[action], target))
+
+    def getStats(self):
+        return {
+            'iterations': self.iterations,
+            'reused': self.reused,
+            'rootVisits': self.root.visits if self.root is not None else 0,
+        }
@@ -0,0 +1,383 @@
+from pacai.core.directions import Directions
+
+# Scared timer the other team gets when a capsule is eaten, as in the capture rules.
+SCARED_TIME = 40
+
+MOVE_VECTORS = (
+    (Directions.NORTH, (0, 1)),
+    (Directions.SOUTH, (0, -1)),
+    (Directions.EAST, (1, 0)),
+    (Directions.WEST, (-1, 0)),
+)
+
+if hasattr(int, 'bit_count'):
+    def popcount(bits):
+        return bits.bit_count()
+else:
+    def popcount(bits):
+        return bin(bits).count('1')
+
+def iterBits(bits):
+    """
+    Indices of the set bits of `bits`, lowest first.
+    """
+    while bits:
+        lowest = bits & -bits
+        yield lowest.bit_length() - 1
+        bits ^= lowest
+
+class SearchRules(object):
+    """
+    The static half of the search's capture simulation, built once per game:
+    where every move from every cell leads, which side of the board each cell is on,
+    every agent's team and start, and the Zobrist keys states are hashed with.
+    Cells are the ids of the MazeDistanceTable, so bit i of a food or capsule bitset
+    is the cell with id i, and regions of the board are precomputed as masks of the same
+    bits (each agent's home and attack side).
+    Counting the capsules in a region is then an AND and a popcount.
+    """
+
+    def __init__(self, gameState, table, zobrist):
+        self.table = table
+        self.zobrist = zobrist
+        self.numAgents = gameState.getNumAgents()
+
+        redTeam = gameState.getRedTeamIndices()
+        self.isRed = [agent in redTeam for agent in range(self.numAgents)]
+        self.enemies = [[other for other in range(self.numAgents)
+                if self.isRed[other] != self.isRed[agent]] for agent in range(self.numAgents)]
+        # food is worth a point to red and minus a point to blue
+        self.foodPoints = [1 if self.isRed[agent] else -1 for agent in range(self.numAgents)]
+
+        halfWidth = gameState.getWalls().width // 2
+        self.redSide = [x < halfWidth for x, y in table.cells]
+        redMask = 0
+        for cell in range(table.numCells):
+            if self.redSide[cell]:
+                redMask |= 1 << cell
+        blueMask = ((1 << table.numCells) - 1) ^ redMask
+        # the cells on the side each agent defends and the side it eats from
+        self.homeMask = [redMask if self.isRed[agent] else blueMask
+                for agent in range(self.numAgents)]
+        self.attackMask = [blueMask if self.isRed[agent] else redMask
+                for agent in range(self.numAgents)]
+
+        # legal moves from every cell and the cell each one leads to
+        self.moves = []
+        self.legalActions = []
+        for cell, (x, y) in enumerate(table.cells):
+            moves = {}
+            for action, (dx, dy) in MOVE_VECTORS:
+                neighbor = table.cellIds.get((x + dx, y + dy))
+                if neighbor is not None:
+                    moves[action] = neighbor
+            moves[Directions.STOP] = cell
+            self.moves.append(moves)
+            self.legalActions.append(list(moves))
+
+        # killed agents go back to where they started the game
+        self.startCells = []
+        self.startDirections = []
+        for agent in range(self.numAgents):
+            agentState = gameState.getAgentState(agent)
+            self.startCells.append(table.getCellId(agentState.getPosition()))
+            self.startDirections.append(agentState.getDirection())
+
+class SearchState(object):
+    """
+    A compact capture position for use inside the search, in place of a full GameState.
+    Per agent we keep a cell id, direction, pacman flag and scared timer in small lists,
+    food and capsules are bitsets over cell ids, and the Zobrist key is kept up to date
+    as moves are applied.
+    The search makes and unmakes moves on one state: `apply` plays a move in place and
+    pushes what it changed (food or a capsule eaten, agents respawned or scared, the
+    score) on the undo stack, `undo` pops the last move and puts it all back.
+    """
+
+    __slots__ = ('rules', 'positions', 'directions', 'pacman', 'scaredTimers',
+            'food', 'capsules', 'score', 'key', 'undoStack')
+
+    def __init__(self, rules, positions, directions, pacman, scaredTimers,
+            food, capsules, score, key = None):
+        self.rules = rules
+        self.positions = positions
+        self.directions = directions
+        self.pacman = pacman
+        self.scaredTimers = scaredTimers
+        self.food = food
+        self.capsules = capsules
+        self.score = score
+        if key is None:
+            key = rules.zobrist.fullKey(self)
+        self.key = key
+        self.undoStack = []
+
+    @classmethod
+    def fromGameState(cls, rules, gameState):
+        table = rules.table
+        positions = []
+        directions = []
+        pacman = []
+        scaredTimers = []
+        for agent in range(rules.numAgents):
+            agentState = gameState.getAgentState(agent)
+            positions.append(table.getCellId(agentState.getPosition()))
+            directions.append(agentState.getDirection())
+            pacman.append(agentState.isPacman())
+            scaredTimers.append(agentState.getScaredTimer())
+
+        foodGrid = gameState.getFood()
+        food = 0
+        for cell, (x, y) in enumerate(table.cells):
+            if foodGrid[x][y]:
+                food |= 1 << cell
+        capsules = 0
+        for pos in gameState.getCapsules():
+            capsules |= 1 << table.getCellId(pos)
+
+        return cls(rules, positions, directions, pacman, scaredTimers,
+                food, capsules, gameState.getScore())
+
+    def __getstate__(self):
+        # the rules are the same all game, whoever unpickles a state attaches their own
+        return (self.positions, self.directions, self.pacman, self.scaredTimers,
+                self.food, self.capsules, self.score, self.key)
+
+    def __setstate__(self, state):
+        (self.positions, self.directions, self.pacman, self.scaredTimers,
+                self.food, self.capsules, self.score, self.key) = state
+        self.rules = None
+        self.undoStack = []
+
+    def getNumAgents(self):
+        return self.rules.numAgents
+
+    def getLegalActions(self, agent):
+        """
+        The legal actions of `agent`, shared between all states, so don't modify it.
+        """
+        return self.rules.legalActions[self.positions[agent]]
+
+    def getAgentPosition(self, agent):
+        return self.rules.table.cells[self.positions[agent]]
+
+    def isPacman(self, agent):
+        return self.pacman[agent]
+
+    def getScaredTimer(self, agent):
+        return self.scaredTimers[agent]
+
+    def getScore(self):
+        return self.score
+
+    def hasFoodAt(self, cell):
+        return self.food >> cell & 1 == 1
+
+    def hasCapsuleAt(self, cell):
+        return self.capsules >> cell & 1 == 1
+
+    def countCapsules(self, mask):
+        """
+        Capsules left on the cells of `mask` (e.g. rules.attackMask[agent]).
+        """
+        return popcount(self.capsules & mask)
+
+    def getFoodList(self, mask = -1):
+        """
+        Positions of the food on the cells of `mask`, like Grid.asList(). For debugging,
+        the search itself sticks to the bitsets.
+        """
+        cells = self.rules.table.cells
+        return [cells[cell] for cell in iterBits(self.food & mask)]
+
+    def agentKey(self, agent):
+        zobrist = self.rules.zobrist
+        value = (zobrist.agentKeys[agent][self.positions[agent]]
+                ^ zobrist.key('timer', agent, self.scaredTimers[agent]))
+        if self.pacman[agent]:
+            value ^= zobrist.pacmanKeys[agent]
+        return value
+
+    def saveAgent(self, agent):
+        return (agent, self.positions[agent], self.directions[agent], self.pacman[agent],
+                self.scaredTimers[agent])
+
+    def respawn(self, agent):
+        rules = self.rules
+        self.positions[agent] = rules.startCells[agent]
+        self.directions[agent] = rules.startDirections[agent]
+        self.pacman[agent] = False
+        self.scaredTimers[agent] = 0
+
+    def apply(self, agent, action):
+        """
+        Plays `action` for `agent` in place, following the capture rules the way
+        generateSuccessor does: move, become a pacman or ghost by side of the board,
+        eat (food scores for the eater's team, a capsule scares the other team),
+        resolve collisions, then the mover's scared timer ticks down.
+        The old values of everything that changed go on the undo stack as one record.
+        """
+        rules = self.rules
+        zobrist = rules.zobrist
+        positions = self.positions
+        scaredTimers = self.scaredTimers
+
+        oldCell = positions[agent]
+        cell = rules.moves[oldCell].get(action)
+        if cell is None:
+            raise ValueError('Illegal action %s for agent %d' % (action, agent))
+        oldDirection = self.directions[agent]
+        oldPacman = self.pacman[agent]
+        oldTimer = scaredTimers[agent]
+        oldFood = self.food
+        oldCapsules = self.capsules
+        oldScore = self.score
+        oldKey = self.key
+        others = None
+
+        key = oldKey ^ self.agentKey(agent)
+        positions[agent] = cell
+        if action != Directions.STOP:  # stopping keeps the direction we were facing
+            self.directions[agent] = action
+        isPacman = rules.isRed[agent] != rules.redSide[cell]
+        self.pacman[agent] = isPacman
+
+        if isPacman:
+            bit = 1 << cell
+            if self.food & bit:
+                self.food ^= bit
+                key ^= zobrist.foodKeys[cell]
+                self.score += rules.foodPoints[agent]
+            elif self.capsules & bit:
+                self.capsules ^= bit
+                key ^= zobrist.capsuleKeys[cell]
+                others = []
+                for enemy in rules.enemies[agent]:
+                    others.append(self.saveAgent(enemy))
+                    key ^= self.agentKey(enemy)
+                    scaredTimers[enemy] = SCARED_TIME
+                    key ^= self.agentKey(enemy)
+
+        # a pacman and a ghost on the same cell: the ghost eats the pacman,
+        # unless the ghost is scared, then it's the other way around
+        for enemy in rules.enemies[agent]:
+            if positions[enemy] != cell or self.pacman[enemy] == isPacman:
+                continue
+            pacmanAgent = agent if isPacman else enemy
+            ghostAgent = enemy if isPacman else agent
+            victim = pacmanAgent if scaredTimers[ghostAgent] <= 0 else ghostAgent
+            if victim == agent:
+                self.respawn(agent)
+                break
+            if others is None:
+                others = []
+            others.append(self.saveAgent(victim))
+            key ^= self.agentKey(victim)
+            self.respawn(victim)
+            key ^= self.agentKey(victim)
+
+        if scaredTimers[agent] > 0:
+            scaredTimers[agent] -= 1
+
+        key ^= self.agentKey(agent)
+        if self.score != oldScore:
+            key ^= zobrist.key('score', oldScore) ^ zobrist.key('score', self.score)
+        self.key = key
+
+        self.undoStack.append((agent, oldCell, oldDirection, oldPacman, oldTimer,
+                oldFood, oldCapsules, oldScore, oldKey, others))
+
+    def undo(self):
+        """
+        Takes back the last move on the undo stack.
+        """
+        agent, cell, direction, pacman, timer, food, capsules, score, key, others = (
+                self.undoStack.pop())
+        if others is not None:
+            for other, otherCell, otherDirection, otherPacman, otherTimer in reversed(others):
+                self.positions[other] = otherCell
+                self.directions[other] = otherDirection
+                self.pacman[other] = otherPacman
+                self.scaredTimers[other] = otherTimer
+        self.positions[agent] = cell
+        self.directions[agent] = direction
+        self.pacman[agent] = pacman
+        self.scaredTimers[agent] = timer
+        self.food = food
+        self.capsules = capsules
+        self.score = score
+        self.key = key
+
+    def isTacticalMove(self):
+        """
+        Whether the last move applied captured an enemy, grabbed a capsule or brought
+        a pacman back home alive.
+        """
+        agent, cell, direction, pacman, timer, food, capsules, score, key, others = (
+                self.undoStack[-1])
+        if others is not None:
+            return True
+        return (pacman and not self.pacman[agent]
+                and self.positions[agent] != self.rules.startCells[agent])
+
+    def undoAll(self):
+        """
+        Takes back every move still on the undo stack, e.g. after a search was interrupted.
+        """
+        while self.undoStack:
+            self.undo()
+
+    def getSnapshot(self):
+        """
+        Everything the state holds, as one comparable tuple.
+        """
+        return (tuple(self.positions), tuple(self.directions), tuple(self.pacman),
+                tuple(self.scaredTimers), self.food, self.capsules, self.score, self.key)
+
+def validateSearchState(rules, gameState, depth = 1):
+    """
+    Checks SearchState against the real game rules. From `gameState`, every legal move of
+    every agent (and `depth` - 1 plies below that) is played with both generateSuccessor
+    and SearchState.apply and the results have to match, Zobrist key included.
+    Undoing each move has to give back the parent.
+    The split into red and blue sides is checked on the cells the game tells us the
+    side of, the ones with food or a capsule on them.
+    Raises ValueError on the first difference. Slow, for debugging and for
+    benchmarkAB's --validate over recorded positions.
+    """
+    redFood = gameState.getRedFood()
+    blueFood = gameState.getBlueFood()
+    redCells = [rules.table.getCellId(pos) for pos in gameState.getRedCapsules()]
+    blueCells = [rules.table.getCellId(pos) for pos in gameState.getBlueCapsules()]
+    for cell, (x, y) in enumerate(rules.table.cells):
+        if redFood[x][y]:
+            redCells.append(cell)
+        elif blueFood[x][y]:
+            blueCells.append(cell)
+    for cell in redCells + blueCells:
+        if rules.redSide[cell] != (cell in redCells):
+            raise ValueError('%s is on the %s side in the search rules but not in the game'
+                    % (rules.table.cells[cell], 'red' if rules.redSide[cell] else 'blue'))
+
+    state = SearchState.fromGameState(rules, gameState)
+    parent = state.getSnapshot()
+    for agent in range(rules.numAgents):
+        legalActions = gameState.getLegalActions(agent)
+        if set(legalActions) != set(state.getLegalActions(agent)):
+            raise ValueError('Legal actions of agent %d are %s in the search state, %s in the game'
+                    % (agent, state.getLegalActions(agent), legalActions))
+
+        for action in legalActions:
+            successor = gameState.generateSuccessor(agent, action)
+            expected = SearchState.fromGameState(rules, successor).getSnapshot()
+            state.apply(agent, action)
+            if state.getSnapshot() != expected:
+                raise ValueError('Search state after agent %d played %s:\n%s\n'
+                        'does not match the game:\n%s'
+                        % (agent, action, state.getSnapshot(), expected))
+            state.undo()
+            if state.getSnapshot() != parent:
+                raise ValueError('Undoing %s for agent %d did not restore the search state'
+                        % (action, agent))
+            if depth > 1:
+                validateSearchState(rules, successor, depth - 1)